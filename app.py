@@ -6,6 +6,8 @@ import os
 import os.path
 import shutil
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json
 
@@ -13,12 +15,27 @@ import mongoengine as me
 from PIL import Image
 from image_match.goldberg import ImageSignature
 from loguru import logger
+from pymongo import UpdateOne
 
 # from gphoto_upload import upload_to_gphotos
+from bulk_writer import BulkWriter, source_archive_add_paths
+from exif_header import parse_exif_header
+from fs_watch import DirectoryWatcher
+from hash_cache import NO_HASHES, cached_md5, hash_cache, put_if_unchanged
+from locality import locality_sorted
 from me_models import DbConnect, Queue, State, Gphoto, SourceArchive
-from utils import file_md5sum, config
+from photo_file_metadata import image_md5_digest
+from tree_walk import walk
+from utils import config
 from firebase import get_firestore_db
 
+WATCH_MODE = True
+TARGET_CHECK_SECONDS = 60
+ADD_ATTEMPTS = 5  # Tries at adding a file that fails to read or decode before it is skipped
+SETTLE_SECONDS = 2.0  # A watched file is only added once its size and mtime hold still this long
+MEMBERSHIP_BATCH = 5000  # Queue photos matched against Gphoto per $in query
+HASH_WORKERS = 8  # Files hashed at once for the membership check
+
 cfg = config()
 logger.add("app.log", rotation="1 MB")
 DbConnect()
@@ -37,6 +54,16 @@ def main():
     """
 
 
+def hash_photo(photo):
+    """photo, a Queue document as a dict, with its md5sum filled in, or None if its file can't be hashed."""
+    try:
+        photo["md5sum"] = cached_md5(photo["src_path"])
+    except OSError as e:  # Moved, deleted or locked since it was queued; try again next pass
+        logger.warning(f"Can't hash {photo['src_path']}: {e}")
+        return None
+    return photo
+
+
 class QueueWorker:
     def __init__(self):
         State.drop_collection()
@@ -46,6 +73,8 @@ class QueueWorker:
             mirror_root=cfg.local.mirror_root,
             status=["\r\n", "\r\n", "Initialized\r\n"],
         ).save()
+        self.gis = ImageSignature()
+        self.deferred = Counter()  # Files that failed to add (still being copied, locked) -> failed tries
 
         # while True:
         #     response = input("Clear upload Queue? (y/n)")
@@ -59,6 +88,9 @@ class QueueWorker:
         self.process_queue()
 
     def process_queue(self):
+        if WATCH_MODE:
+            self.watch_queue()
+            return
         while True:
             self.add_candidates()
             # self.check_gphotos_membership()
@@ -70,6 +102,36 @@ class QueueWorker:
             #     print("Waiting...")
             #     time.sleep(5)
 
+    def watch_queue(self):
+        """
+        Event-driven alternative to the poll loop: after the initial walk of a new target only the files
+        touched in the target directories or the upload queue folder are processed. The watcher is
+        started before the walk, so files created while the walk runs are reported even if it has
+        already passed them. Files still being written, and files that fail to add, are retried whenever
+        the worker goes idle. While idle the only database access is the target check every
+        TARGET_CHECK_SECONDS.
+        """
+        watcher = None
+        while True:
+            new_target = self.new_target_list()
+            if new_target or watcher is None:
+                if watcher is not None:
+                    watcher.stop()
+                watcher = DirectoryWatcher(
+                    [cfg.local.gphoto_upload_queue, *self.state.dirlist],
+                    extensions=cfg.local.image_filetypes,
+                )
+                watcher.start()
+            if new_target:
+                self.walk_targets()
+            for paths in watcher.batches(timeout=TARGET_CHECK_SECONDS):
+                if not paths:
+                    break
+                logger.info(f"{len(paths)} files changed")
+                self.add_settled(paths)
+            if self.deferred:
+                self.add_settled(list(self.deferred))
+
     def new_target_list(self):
         self.state.reload()
         if self.state.target == self.state.old_target:
@@ -84,93 +146,181 @@ class QueueWorker:
 
     def add_candidates(self):
         if not self.new_target_list():
-            return ()
+            return False
+        self.walk_targets()
+        return True
+
+    def walk_targets(self):
         dirsize = 0
         start = datetime.datetime.now()
         logger.info(f"Walking target list: {self.state.dirlist}")
-        gis = ImageSignature()
+        excluded = Counter(self.state.excluded_ext_dict)
         for top in self.state.dirlist:
             message = f"Traversing tree at {top} and adding to queue."
             logger.info(message)
             self.status(message)
-            top_path = Path(top)
-            for path in top_path.rglob("**/*"):
-                ext = path.suffix.lower()
-                if ext in cfg.settings.image_filetypes:
-                    size = path.stat().st_size
-                    dirsize += size
-                    photo_b = self.get_bytes(path)
-                    md5sum = hashlib.md5(photo_b).hexdigest()
-                    # if not MD%sum already in database:
-                    im = Image.open(io.BytesIO(photo_b))
-                    tags = {
-                        "cameraMake": im.info['parsed_exif'].get(0x010f, ""),
-                        "cameraModel": im.info['parsed_exif'].get(0x0110, ""),
-                        "creationTime": im.info['parsed_exif'].get(0x9003, ""),
-                        "width": im.width,
-                        "height": im.height,
-                    }
-                    image_md5 = hashlib.md5(im.tobytes()).hexdigest()
-                    signature = gis.generate_signature(
-                        photo_b, bytestream=True
-                    ).tolist()
-                    record = {
-                        "src_path": str(path),
-                        "size": size,
-                        "md5sum": md5sum,
-                        "image_md5": image_md5,
-                        "signature": signature,
-                        "mediaMetadata": tags,
-                    }
-                    photos.add(record)
-                    logger.info(f"Added: {path}")
-                else:
-                    ext = ext.replace(
-                        ".", ""
-                    )  # Database can't handle keys starting with dot
-                    excluded = self.state.excluded_ext_dict
-                    if ext in excluded:
-                        excluded[ext] += 1
-                    else:
-                        excluded[ext] = 1
-                    self.state.update(excluded_ext_dict=excluded)
+            for entry in walk([top], extensions=cfg.local.image_filetypes, excluded=excluded):
+                dirsize += entry.size
+                self.try_add_file(entry.path, entry.size)
+            self.state.update(excluded_ext_dict=dict(excluded))
         self.state.save()
         elapsed = datetime.datetime.now() - start
         self.state.modify(
             dirsize=self.state.dirsize + dirsize,
             dirtime=elapsed.seconds + elapsed.microseconds / 1e6,
         )
-        return
+
+    def add_settled(self, paths):
+        """
+        try_add_file each of paths whose size and mtime are the same across two stats SETTLE_SECONDS
+        apart. A copy can stall for longer than the watcher's debounce, and a half-written file may
+        still decode, so the rest are deferred, without using up a try, until they settle.
+        """
+        first = {}
+        for path in sorted(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.try_add_file(path)  # Gone or unreadable; handled and logged there
+                continue
+            first[path] = st.st_size, st.st_mtime_ns
+        if not first:
+            return
+        time.sleep(SETTLE_SECONDS)
+        for path, before in first.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.try_add_file(path)
+                continue
+            if (st.st_size, st.st_mtime_ns) != before:
+                logger.info(f"{path} is still being written; will retry")
+                self.deferred[path] += 0
+                continue
+            self.try_add_file(path, st.st_size)
+
+    def try_add_file(self, path, size=None):
+        """
+        add_file, logging instead of raising when the file can't be added. A file that is gone is
+        dropped; one that can't be read or decoded yet (still being copied, locked by another process,
+        truncated) is kept in self.deferred and skipped after ADD_ATTEMPTS failed tries.
+        """
+        try:
+            self.add_file(path, os.path.getsize(path) if size is None else size)
+        except FileNotFoundError:
+            logger.info(f"Gone before it could be added: {path}")
+        except Exception as e:  # OSError, or whatever PIL or the header parser raise for a partial file
+            self.deferred[path] += 1
+            if self.deferred[path] < ADD_ATTEMPTS:
+                logger.info(f"Can't add {path} yet ({e!r}); will retry")
+                return
+            logger.warning(f"Skipping {path} after {ADD_ATTEMPTS} failed tries: {e!r}")
+        self.deferred.pop(path, None)
+
+    def add_file(self, path, size):
+        st = os.stat(path)
+        cached = hash_cache().get(st) or NO_HASHES
+        photo_b = self.get_bytes(path)
+        md5sum = cached.md5sum or hashlib.md5(photo_b).hexdigest()
+        # if not MD%sum already in database:
+        im = Image.open(io.BytesIO(photo_b))
+        header = parse_exif_header(photo_b)
+        tags = {
+            "cameraMake": header.make,
+            "cameraModel": header.model,
+            "creationTime": header.datetime_original,
+            "width": im.width,
+            "height": im.height,
+        }
+        image_md5 = cached.image_md5 or image_md5_digest(im)
+        put_if_unchanged(st, path, md5sum=md5sum, image_md5=image_md5)
+        signature = self.gis.generate_signature(
+            photo_b, bytestream=True
+        ).tolist()
+        record = {
+            "src_path": path,
+            "size": size,
+            "md5sum": md5sum,
+            "image_md5": image_md5,
+            "signature": signature,
+            "mediaMetadata": tags,
+        }
+        photos.add(record)
+        logger.info(f"Added: {path}")
 
     # noinspection PyMethodMayBeStatic
 
     # noinspection PyMethodMayBeStatic
     def check_gphotos_membership(self):
+        """
+        Match the Queue photos not yet known to be in Gphotos against Gphoto by MD5, as a set-based join:
+        the Queue is streamed once, the MD5s of MEMBERSHIP_BATCH photos at a time are looked up with a
+        single $in query, and the results go back to Queue and SourceArchive as unordered bulk writes.
+        A million photos take a few thousand round trips instead of four per photo.
+        """
         self.status("Checking for photos not in Gphotos")
-        for photo in Queue.objects(me.Q(md5sum__ne=None) & me.Q(in_gphotos__ne=True)):
-            match = Gphoto.objects(md5Checksum=photo.md5sum).first()
-            if match:
-                photo.gphotos_path = match.path
-                photo.gid = match.gid
-                photo.in_gphotos = True
-                photo.original_filename = match.originalFilename
-                logger.info(f"In Gphotos: {photo.src_path}")
-            else:
-                if photo.in_process is False:
-                    logger.info(f"Not in Gphotos: {photo.src_path}")
-                photo.in_gphotos = False
-            photo.in_process = True
-            photo.save()
-            try:
-                sources = SourceArchive.objects(md5sum=photo.md5sum).get()
-            except me.DoesNotExist:
-                SourceArchive(md5sum=photo.md5sum, paths=[photo.src_path]).save()
-            else:
-                sources.update(add_to_set__paths=[photo.src_path])
+        # A photo can only be in Gphotos if some Gphoto has exactly its size, so only those need an MD5.
+        # Streamed from a cursor: distinct returns one reply, which a large library's sizes overflow.
+        gphoto_sizes = {
+            group["_id"]
+            for group in Gphoto._get_collection().aggregate([{"$group": {"_id": "$gsize"}}], allowDiskUse=True)
+        }
+        pending = Queue.objects(in_gphotos__ne=True).only("src_path", "size", "md5sum", "in_process")
+        with BulkWriter(Queue._get_collection()) as queue_writer, \
+                BulkWriter(SourceArchive._get_collection()) as archive_writer, \
+                ThreadPoolExecutor(max_workers=HASH_WORKERS) as hash_pool:
+            batch = []
+            unhashed = []
+            for photo in pending.as_pymongo().timeout(False):
+                if photo.get("md5sum") is None:
+                    if photo.get("size") not in gphoto_sizes:
+                        if photo.get("in_process") is False:
+                            logger.info(f"Not in Gphotos (no size match): {photo['src_path']}")
+                        queue_writer.add(
+                            UpdateOne({"_id": photo["_id"]}, {"$set": {"in_gphotos": False, "in_process": True}})
+                        )
+                        continue
+                    unhashed.append(photo)
+                else:
+                    batch.append(photo)
+                if len(batch) + len(unhashed) >= MEMBERSHIP_BATCH:
+                    batch += [photo for photo in hash_pool.map(hash_photo, unhashed) if photo is not None]
+                    self.match_gphotos(batch, queue_writer, archive_writer)
+                    batch = []
+                    unhashed = []
+            batch += [photo for photo in hash_pool.map(hash_photo, unhashed) if photo is not None]
+            self.match_gphotos(batch, queue_writer, archive_writer)
         logger.info(
             f"In gphotos: {Queue.objects(in_gphotos=True).count()}, Not in gphotos: {Queue.objects(in_gphotos=False).count()}"
         )
 
+    # noinspection PyMethodMayBeStatic
+    def match_gphotos(self, batch, queue_writer, archive_writer):
+        """
+        Look up the MD5s of batch, Queue documents as dicts, in Gphoto with one query and queue the
+        resulting Queue updates and SourceArchive path additions on the writers.
+        """
+        if not batch:
+            return
+        matches = {}
+        md5s = list({photo["md5sum"] for photo in batch})
+        for match in Gphoto.objects(md5Checksum__in=md5s).only("md5Checksum", "gid", "originalFilename").as_pymongo():
+            matches.setdefault(match["md5Checksum"], match)
+        paths = {}
+        for photo in batch:
+            match = matches.get(photo["md5sum"])
+            fields = {"md5sum": photo["md5sum"], "in_gphotos": match is not None, "in_process": True}
+            if match:
+                fields.update(gid=match.get("gid"), original_filename=match.get("originalFilename"))
+                logger.info(f"In Gphotos: {photo['src_path']}")
+            elif photo.get("in_process") is False:
+                logger.info(f"Not in Gphotos: {photo['src_path']}")
+            queue_writer.add(UpdateOne({"_id": photo["_id"]}, {"$set": fields}))
+            paths.setdefault(photo["md5sum"], []).append(photo["src_path"])
+        for md5sum, src_paths in paths.items():
+            archive_writer.add(source_archive_add_paths(md5sum, src_paths))
+        logger.debug(f"Matched {len(batch)} photos against Gphoto: {sum(m in matches for m in md5s)} of {len(md5s)} MD5s found")
+
     # # noinspection PyMethodMayBeStatic
     # def upload_missing_media(self):
     #     if not self.state.upload_ok:
@@ -205,7 +355,7 @@ class QueueWorker:
         if not dest.is_file():
             self.copy_file(photo=photo, dest=dest)
             return
-        if file_md5sum(dest) == file_md5sum(photo.src_path):
+        if cached_md5(dest) == cached_md5(photo.src_path):
             logger.info(f"Already mirrored: {photo.src_path}")
             if self.state.purge_ok:
                 os.remove(photo.src_path)
@@ -230,7 +380,8 @@ class QueueWorker:
 
     def dequeue(self):
         if self.state.mirror_ok:
-            for photo in Queue.objects(me.Q(in_gphotos=True) & me.Q(mirrored=False)):
+            pending = Queue.objects(me.Q(in_gphotos=True) & me.Q(mirrored=False))
+            for photo in locality_sorted(pending, path=lambda p: p.src_path):  # Read the source disk in order
                 self.mirror_file(photo)
         if self.state.purge_ok:
             for photo in Queue.objects(
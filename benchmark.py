@@ -0,0 +1,257 @@
+import math
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+from PIL import Image
+from loguru import logger
+
+from locality import LocalityScheduler
+from photo_file_metadata import image_md5_digest
+from rate_limit import RequestScheduler
+
+SYNTHETIC_SIZES = [(4000, 3000), (8660, 5774)]  # 12 MP and 50 MP
+
+# Simulated spinning disk for the scheduling benchmark
+HDD_SETTLE_MS = 2.0
+HDD_FULL_STROKE_MS = 15.0
+HDD_MB_PER_SECOND = 120
+HDD_DECODE_MS = 40.0  # CPU time per file before the worker asks for its next one
+HDD_DEVICES = 2
+HDD_DIRECTORIES = 200
+HDD_FILES_PER_DIRECTORY = 50
+HDD_CHUNK_SIZE = 50
+
+# Local stand-in for a Google API for the throttling benchmark
+FAKE_QUOTA = 40  # Requests a second the fake API serves before answering 429
+FAKE_LATENCY_MS = 20.0
+FAKE_ERROR_RATE = 0.02  # Share of requests answered 503 regardless of load
+FAKE_REQUESTS = 400
+FAKE_CLIENTS = 16
+
+
+def main():
+    """
+    python benchmark.py image_md5 [image paths...]
+    python benchmark.py hdd [worker counts...]
+    python benchmark.py throttle [quota]
+    """
+    benchmarks = {"image_md5": bench_image_md5, "hdd": bench_hdd, "throttle": bench_throttle}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"Usage: python benchmark.py {{{'|'.join(benchmarks)}}} [args...]")
+        return
+    benchmarks[sys.argv[1]](sys.argv[2:])
+
+
+def measure(fn, *args):
+    """Run fn(*args) and return (result, seconds, peak bytes allocated by Python while it ran)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def synthetic_images():
+    for width, height in SYNTHETIC_SIZES:
+        yield f"synthetic {width}x{height}", Image.effect_noise((width, height), 64).convert("RGB")
+
+
+def bench_image_md5(paths):
+    """
+    Check that image_md5_digest gives the same digest as md5(im.tobytes()) and compare time and peak
+    memory. Images are decoded before measuring, so only the hashing is compared.
+    """
+    images = ((path, Image.open(path)) for path in paths) if paths else synthetic_images()
+    for name, im in images:
+        im.load()
+        full_digest, full_time, full_peak = measure(lambda i: md5(i.tobytes()).hexdigest(), im)
+        strip_digest, strip_time, strip_peak = measure(image_md5_digest, im)
+        assert full_digest == strip_digest, f"{name}: strip digest {strip_digest} != tobytes digest {full_digest}"
+        logger.info(
+            f"{name} {im.mode}: tobytes {full_time:.2f}s, peak {full_peak / 2**20:.1f} MiB | "
+            f"strips {strip_time:.2f}s, peak {strip_peak / 2**20:.1f} MiB | digests match"
+        )
+
+
+class SimulatedFile(NamedTuple):
+    dev: int
+    directory: str
+    inode: int
+    position: int
+    size: int
+
+
+def simulated_files(seed=0):
+    """Photo-sized files on HDD_DEVICES disks, laid out directory by directory with inodes in disk order."""
+    rng = random.Random(seed)
+    files = []
+    for dev in range(HDD_DEVICES):
+        position = 0
+        for d in range(HDD_DIRECTORIES):
+            for _ in range(HDD_FILES_PER_DIRECTORY):
+                size = rng.randint(2 << 20, 8 << 20)
+                files.append(SimulatedFile(dev, f"dir{d:04}", len(files), position, size))
+                position += size
+    return files
+
+
+def simulate_hdd(take, workers, span):
+    """
+    Simulated seconds for workers to read every file, where take(worker) returns the worker's next
+    chunk of files. Each worker has one read outstanding at a time, and each disk serves the waiting
+    read nearest its head, as an elevator scheduler would. A seek costs settle time plus the square root
+    of the distance as a fraction of span. Returns (seconds, seeks).
+    """
+    free = [0.0] * HDD_DEVICES
+    heads = [0] * HDD_DEVICES
+    seeks = 0
+    ready = [0.0] * workers
+    chunks = [[] for _ in range(workers)]
+    finished = [False] * workers
+    while True:
+        for k in range(workers):
+            if not chunks[k] and not finished[k]:
+                chunks[k] = list(take(k))
+                finished[k] = not chunks[k]
+        waiting = [k for k in range(workers) if chunks[k]]
+        if not waiting:
+            return max(*free, *ready), seeks
+        # The next read served is on the disk that can start one soonest
+        start, dev = min((max(free[chunks[k][0].dev], ready[k]), chunks[k][0].dev) for k in waiting)
+        candidates = [k for k in waiting if chunks[k][0].dev == dev and ready[k] <= start]
+        k = min(candidates, key=lambda k: abs(chunks[k][0].position - heads[dev]))
+        f = chunks[k].pop(0)
+        distance = abs(f.position - heads[dev])
+        clock = start
+        if distance:
+            seeks += 1
+            clock += (HDD_SETTLE_MS + (HDD_FULL_STROKE_MS - HDD_SETTLE_MS) * math.sqrt(distance / span)) / 1000
+        clock += f.size / (HDD_MB_PER_SECOND * 2**20)
+        free[dev] = clock
+        heads[dev] = f.position + f.size
+        ready[k] = clock + HDD_DECODE_MS / 1000
+
+
+def bench_hdd(args):
+    """
+    Compare job orders on simulated HDDs: the arbitrary order Queue.objects() returns, one global
+    device/directory order with chunks going to whichever worker is free, and LocalityScheduler.
+    """
+    files = simulated_files()
+    span = max(f.position + f.size for f in files)
+    total_mb = sum(f.size for f in files) / 2**20
+
+    def shared_chunks(order):
+        chunks = iter([order[i:i + HDD_CHUNK_SIZE] for i in range(0, len(order), HDD_CHUNK_SIZE)])
+        return lambda worker: next(chunks, [])
+
+    for workers in [int(a) for a in args] or [1, 3, 8]:
+        arbitrary = random.Random(1).sample(files, len(files))
+        scheduler = LocalityScheduler(arbitrary, workers, key=lambda f: (f.dev, f.directory, f.inode))
+        strategies = {
+            "arbitrary order": shared_chunks(arbitrary),
+            "directory order": shared_chunks(sorted(files, key=lambda f: (f.dev, f.directory, f.inode))),
+            "locality scheduler": lambda worker: scheduler.take(worker, HDD_CHUNK_SIZE),
+        }
+        for name, take in strategies.items():
+            seconds, seeks = simulate_hdd(take, workers, span)
+            logger.info(
+                f"{workers} workers, {name}: {seconds:.0f}s simulated, {total_mb / seconds:.1f} MB/s, {seeks} seeks"
+            )
+        logger.info(f"{workers} workers: {scheduler.steals} steals")
+
+
+class FakeQuotaHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET like a quota-limited Google API: 429 once server.quota requests have been served in the
+    last second, otherwise 503 for a share of FAKE_ERROR_RATE and 200 for the rest.
+    """
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(FAKE_LATENCY_MS / 1000)
+        with server.lock:
+            now = time.monotonic()
+            while server.served and server.served[0] < now - 1:
+                server.served.popleft()
+            if len(server.served) >= server.quota:
+                status = 429
+            elif random.random() < FAKE_ERROR_RATE:
+                status = 503
+            else:
+                status = 200
+                server.served.append(now)
+            server.counts[status] += 1
+        body = b"{}" if status == 200 else b'{"error": {"code": %d}}' % status
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def fake_quota_server(quota):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeQuotaHandler)
+    server.daemon_threads = True
+    server.quota = quota
+    server.lock = threading.Lock()
+    server.served = deque()
+    server.counts = Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_throttle(args):
+    """
+    FAKE_REQUESTS requests from FAKE_CLIENTS threads against a local server enforcing a quota, sent
+    directly and through a RequestScheduler that starts out at four times the quota.
+    """
+    quota = int(args[0]) if args else FAKE_QUOTA
+    server = fake_quota_server(quota)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    def get():
+        with urllib.request.urlopen(url) as r:
+            return r.read()
+
+    api = RequestScheduler("fake", rate=4 * quota, burst=quota, concurrency=FAKE_CLIENTS)
+    senders = {"direct": get, "scheduler": lambda: api.call(get)}
+    for name, send in senders.items():
+        server.counts.clear()
+
+        def attempt(_):
+            try:
+                send()
+                return True
+            except urllib.error.HTTPError:
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=FAKE_CLIENTS) as pool:
+            ok = sum(pool.map(attempt, range(FAKE_REQUESTS)))
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"{name}: {ok}/{FAKE_REQUESTS} succeeded in {elapsed:.1f}s ({ok / elapsed:.1f}/s against a quota of "
+            f"{quota}/s); server answered {server.counts[429]} 429s and {server.counts[503]} 503s"
+        )
+    api.log_metrics()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
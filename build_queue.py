@@ -1,12 +1,12 @@
 import datetime
 from collections import Counter
-from pathlib import Path
 from typing import List
 
 from loguru import logger
-import arrow
 
+from bulk_writer import FLUSH_SECONDS, WRITE_BATCH_SIZE, BulkWriter, queue_upsert
 from me_models import DbConnect, Queue
+from tree_walk import walk
 from utils import config
 
 cfg = config()
@@ -14,24 +14,14 @@ logger.add("build_queue.log", rotation="1 MB")
 DbConnect()
 
 
-def add_candidates(dirlist: List[str]):
+def add_candidates(dirlist: List[str], batch_size=WRITE_BATCH_SIZE, flush_seconds=FLUSH_SECONDS):
     logger.info(f"Walking target list: {dirlist}")
     excluded = Counter()
-    for top in dirlist:
-        logger.info(f"Traversing tree at {top} and adding to queue.")
-        top_path = Path(top)
-        for path in top_path.rglob("**/*"):
-            ext = path.suffix.lower()
-            if ext in cfg.settings.image_filetypes:
-                Queue(
-                    src_path=str(path),
-                    src_filename=str(path.name),
-                    size=path.stat().st_size,
-                    modifiedTime=arrow.get(path.stat().st_mtime).datetime
-                ).save()
-            else:
-                excluded.update([ext.replace(".", "")])
-                logger.info(f"Skipped file: {path}")
+    with BulkWriter(Queue._get_collection(), batch_size=batch_size, flush_seconds=flush_seconds) as writer:
+        for top in dirlist:
+            logger.info(f"Traversing tree at {top} and adding to queue.")
+            for record in walk([top], extensions=cfg.local.image_filetypes, excluded=excluded):
+                writer.add(queue_upsert(record.path, record.size, record.mtime))
     return excluded
 
 
@@ -0,0 +1,155 @@
+import datetime
+import os.path
+import time
+
+import arrow
+from loguru import logger
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from me_models import Queue, Src_metadata
+
+WRITE_BATCH_SIZE = 1000
+FLUSH_SECONDS = 5.0
+DUPLICATE_KEY = 11000
+# Queue fields that describe a file's previous content, reset by queue_upsert when the content changes
+RESET_FIELDS = {
+    "in_gphotos": False,
+    "gid": None,
+    "original_filename": None,
+    "mirrored": False,
+    "in_process": False,
+    "lease_owner": None,
+    "lease_expires": None,
+}
+
+
+class BulkWriter:
+    """
+    Buffers pymongo write operations and applies them to a collection with unordered bulk writes,
+    flushing when batch_size operations are pending or flush_seconds have passed since the last flush.
+    A failed operation doesn't stop the rest of its batch; failures are logged and counted. If the
+    write fails as a whole (the server is unreachable, say), the batch goes back to the front of the
+    pending operations and the error is raised, so the caller can flush again later.
+    """
+
+    def __init__(self, collection, batch_size=WRITE_BATCH_SIZE, flush_seconds=FLUSH_SECONDS):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.counts = dict(operations=0, inserted=0, upserted=0, matched=0, modified=0, deleted=0, errors=0)
+        self.start = self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        logger.info(self.report())
+
+    def add(self, operation):
+        self.pending.append(operation)
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        retry = []
+        try:
+            self._tally(self.collection.bulk_write(batch, ordered=False).bulk_api_result)
+        except BulkWriteError as e:
+            self._tally(e.details)
+            for error in e.details["writeErrors"]:
+                if error["code"] == DUPLICATE_KEY:  # Lost an upsert race; the retry matches the winner
+                    retry.append(batch[error["index"]])
+                else:
+                    self.counts["errors"] += 1
+                    logger.warning(f"Bulk write error: {error['errmsg']} in {error['op']}")
+        except Exception:
+            self.pending = batch + self.pending
+            raise
+        self.counts["operations"] += len(batch)
+        if retry:
+            logger.info(f"Retrying {len(retry)} operations that hit duplicate keys")
+            try:
+                self._tally(self.collection.bulk_write(retry, ordered=False).bulk_api_result)
+            except BulkWriteError as e:
+                self._tally(e.details)
+                self.counts["errors"] += len(e.details["writeErrors"])
+                logger.warning(f"Bulk write retry failed: {e.details['writeErrors']}")
+            except Exception:
+                self.pending = retry + self.pending
+                raise
+        logger.debug(self.report())
+
+    def _tally(self, result):
+        self.counts["inserted"] += result.get("nInserted", 0)
+        self.counts["upserted"] += result.get("nUpserted", 0)
+        self.counts["matched"] += result.get("nMatched", 0)
+        self.counts["modified"] += result.get("nModified", 0)
+        self.counts["deleted"] += result.get("nRemoved", 0)
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.counts["operations"] / elapsed if elapsed else 0.0
+        counts = ", ".join(f"{k}: {v}" for k, v in self.counts.items())
+        return f"Bulk writes to {self.collection.name}: {counts} in {datetime.timedelta(seconds=elapsed)} ({rate:.0f} ops/s)"
+
+
+def queue_upsert(path, size, mtime, reset=False):
+    """
+    Queue upsert keyed on src_path, so ingesting a file that is already queued updates it in place.
+    :param path: Source file path
+    :param size: File size in bytes
+    :param mtime: Modification time in seconds since the epoch
+    :param reset: The file content changed: clear the hashes and metadata computed from the old content,
+        and what was known about it in Google Photos and the mirror, so the new content is checked again
+    """
+    current = {
+        "src_path": str(path),
+        "src_filename": os.path.basename(path),
+        "size": size,
+        "modifiedTime": arrow.get(mtime).datetime,
+    }
+    if reset:
+        current.update(RESET_FIELDS)
+    defaults = {k: v for k, v in Queue().to_mongo().items() if k not in current}
+    update = {"$set": current, "$setOnInsert": defaults}
+    if reset:
+        update["$unset"] = {"md5sum": "", "image_md5": "", "src_metadata": ""}
+    return UpdateOne({"src_path": str(path)}, update, upsert=True)
+
+
+def gphoto_upsert(node, overwrite=False):
+    """
+    Gphoto upsert keyed on gid.
+    :param node: Gphoto document from a Drive file resource
+    :param overwrite: Replace the fields of an existing record ($set); by default an existing record is
+        left as it is and the fields only apply to an insert ($setOnInsert)
+    """
+    fields = node.to_mongo().to_dict()
+    fields.pop("_id", None)
+    return UpdateOne({"gid": node.gid}, {"$set" if overwrite else "$setOnInsert": fields}, upsert=True)
+
+
+def source_archive_add_paths(md5sum, paths):
+    """SourceArchive upsert keyed on md5sum adding paths to the record's paths, as add_to_set__paths does."""
+    return UpdateOne({"md5sum": md5sum}, {"$addToSet": {"paths": {"$each": list(paths)}}}, upsert=True)
+
+
+def queue_metadata_update(photo_id, metadata, hashes=True, **extra):
+    """
+    Queue update applying a photo_file_metadata.ImageMetadata, the bulk equivalent of
+    Photo.apply_metadata followed by save().
+    :param hashes: Also set md5sum and image_md5; False for metadata_only results, which have none
+    :param extra: Further fields to set
+    """
+    fields = {"md5sum": metadata.md5sum or None, "image_md5": metadata.image_md5 or None} if hashes else {}
+    if metadata.width:
+        fields["src_metadata"] = Src_metadata.from_image_metadata(metadata).to_mongo()
+    fields.update(extra)
+    return UpdateOne({"_id": photo_id}, {"$set": fields})
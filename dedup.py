@@ -0,0 +1,60 @@
+from collections import defaultdict
+from hashlib import md5
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from loguru import logger
+
+from hash_cache import cached_md5
+
+PROBE_BYTES = 64 * 1024
+
+
+def probe_hash(path, size) -> str:
+    """MD5 of the first and last PROBE_BYTES of a file."""
+    digest = md5()
+    with open(path, "rb") as fp:
+        digest.update(fp.read(PROBE_BYTES))
+        if size > 2 * PROBE_BYTES:
+            fp.seek(-PROBE_BYTES, 2)
+        digest.update(fp.read(PROBE_BYTES))
+    return digest.hexdigest()
+
+
+def find_duplicates(files: Iterable[Tuple[str, int]]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yield (md5sum, paths) for every set of files with identical content.
+
+    Files are grouped by exact size first; only sizes shared by several files get a probe hash of their
+    first and last PROBE_BYTES, and only files whose probes still collide are read in full.
+    :param files: (path, size) pairs
+    """
+    by_size: Dict[int, List[str]] = defaultdict(list)
+    for path, size in files:
+        by_size[size].append(path)
+    size_groups = {size: paths for size, paths in by_size.items() if len(paths) > 1}
+    logger.info(f"Size stage: {len(by_size)} sizes, {len(size_groups)} shared by more than one file")
+
+    probed = full = 0
+    for size, paths in size_groups.items():
+        probed += len(paths)
+        for probe_group in _group(paths, lambda p: probe_hash(p, size)):
+            full += len(probe_group)
+            yield from _group_keyed(probe_group, cached_md5)
+    logger.info(f"Probe hashed {probed} files, fully hashed {full}")
+
+
+def _group(paths, key):
+    for _, group in _group_keyed(paths, key):
+        yield group
+
+
+def _group_keyed(paths, key):
+    groups = defaultdict(list)
+    for path in paths:
+        try:
+            groups[key(path)].append(path)
+        except OSError as e:
+            logger.warning(f"Can't read {path}: {e}")
+    for k, group in groups.items():
+        if len(group) > 1:
+            yield k, group
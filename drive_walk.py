@@ -1,23 +1,34 @@
 import os.path
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import mongoengine as me
 import datetime
-import functools
 from dataclasses import dataclass
 import oauth2creds
 from googleapiclient.discovery import build
 from loguru import logger
+from pymongo import DeleteMany
 
 import utils
-from me_models import Gphoto, Gphoto_state
+from bulk_writer import WRITE_BATCH_SIZE, BulkWriter, gphoto_upsert
+from me_models import Gphoto, GphotoState
+from rate_limit import scheduler
 
 FOLDER = "application/vnd.google-apps.folder"
 FILE_FIELDS = "id,imageMediaMetadata/time,md5Checksum,mimeType,name,originalFilename,ownedByMe,parents,size,trashed"
 INIT_FIELDS = f"files({FILE_FIELDS}), nextPageToken"
-UPDATE_FIELDS = f"changes(file({FILE_FIELDS}),fileId,removed),nextPageToken"
+UPDATE_FIELDS = f"changes(file({FILE_FIELDS}),fileId,removed),nextPageToken,newStartPageToken"
 MIME_FILTER = ["image", "video", "application/vnd.google-apps.folder"]
+WALK_WORKERS = 8  # Folder listings in flight at once during a rebuild
+BATCH_LIMIT = 100  # Drive's maximum number of requests in one batch HTTP request
+NODE_QUERY = "'{}' in parents and (mimeType contains 'image/' or mimeType contains 'video/' or mimeType = 'application/vnd.google-apps.folder') and trashed = false"
+INSERT_BATCH = 1000
+SHADOW_SUFFIX = "_rebuild"  # rebuild_db loads into <collection>_rebuild before swapping it in
 
 cfg = utils.config()
-service = build("drive", "v3", credentials=oauth2creds.get_credentials())
 me.connect(
     db=cfg.gphotos.database, host=cfg.gphotos.host, alias=cfg.gphotos.gphoto_db_alias
 )
@@ -28,72 +39,253 @@ def main():
     gsync.sync()
 
 
+def new_service():
+    return build("drive", "v3", credentials=oauth2creds.get_credentials())
+
+
+class FolderIndex:
+    """
+    gid -> (parent gid, name) of every folder, so the path of a node resolves in memory instead of with
+    one query per ancestor. Resolved paths are remembered until a folder is added, moved or removed.
+    Paths are those walk gives: the names of the folders from the root, root_name included, down to
+    the node's parent.
+    """
+
+    def __init__(self, root_gid, root_name):
+        self.root_gid = root_gid
+        self.root_name = root_name
+        self.folders = {}
+        self.paths = {root_gid: (root_name,)}
+
+    @classmethod
+    def load(cls, root_gid, root_name):
+        """Index every folder in the Gphoto collection, with a single query."""
+        index = cls(root_gid, root_name)
+        for doc in Gphoto.objects(mimeType=FOLDER).only("gid", "parents", "name").as_pymongo():
+            index.folders[doc["gid"]] = ((doc.get("parents") or [None])[0], doc.get("name"))
+        logger.info(f"Folder index loaded with {len(index.folders)} folders")
+        return index
+
+    def __contains__(self, gid):
+        return gid in self.folders
+
+    def add(self, node):
+        if node.trashed:
+            self.remove(node.gid)
+            return
+        self.folders[node.gid] = (node.parents[0] if node.parents else None, node.name)
+        self.paths = {self.root_gid: (self.root_name,)}
+
+    def remove(self, gid):
+        if self.folders.pop(gid, None):
+            self.paths = {self.root_gid: (self.root_name,)}
+
+    def node_path(self, node):
+        assert len(node.parents) > 0, "Got node with no parents"
+        return list(self.path(node.parents[0]))
+
+    def path(self, gid):
+        """Folder names from the root down to and including folder gid."""
+        chain = []
+        while gid != self.root_gid and gid not in self.paths:
+            if gid not in self.folders:
+                logger.warning(f"Folder {gid} is not in the index; its path starts below it")
+                break
+            if gid in chain:
+                logger.warning(f"Folder cycle at {gid}")
+                break
+            chain.append(gid)
+            gid = self.folders[gid][0]
+        path = self.paths.get(gid, ())
+        for folder in reversed(chain):
+            path = path + (self.folders[folder][1],)
+            self.paths[folder] = path
+        return path
+
+
 class GphotoSync:
-    def __init__(self):
+    def __init__(self, service_factory=new_service, workers=WALK_WORKERS, api=None):
+        """
+        :param service_factory: Returns a Drive API service; called once per thread, because the
+            httplib2 connection under a service isn't thread safe. Pass a stand-in to run offline.
+        :param workers: Folder listings in flight at once during a rebuild
+        :param api: rate_limit.RequestScheduler every Drive request goes through; the shared "drive" one
+            by default
+        """
+        self.service_factory = service_factory
+        self.workers = workers
+        self.api = api or scheduler("drive")
+        self.local = threading.local()
+        self.folder_index = None  # Loaded when a sync resolves paths
         self.root = self.get_root()
 
+    def service(self):
+        if not hasattr(self.local, "service"):
+            self.local.service = self.service_factory()
+        return self.local.service
+
     def sync(self):
         if self.database_clean() and self.start_token() is not None:
             self.update_db()
         else:
             logger.info("Database dirty: Rebulding")
             self.rebuild_db()
-        self.start_token(update=True)
+        self.api.log_metrics()
 
     def rebuild_db(self):
+        """
+        Rebuild the Gphoto collection from a full walk of Drive. The walk is loaded into a shadow
+        collection with unindexed bulk inserts, indexed once loaded, and then renamed over the live
+        collection, which is replaced atomically. Until then readers keep seeing the previous, complete
+        collection, and a failed rebuild leaves it untouched.
+        """
         start_time = datetime.datetime.now()
+        # Taken before the walk, so the next sync picks up whatever changes while it runs
+        start_token = self.execute(self.service().changes().getStartPageToken())["startPageToken"]
         self.database_clean(set_state=False)
-        Gphoto.drop_collection()
-        self.walk(folder=self.root)
+        live = Gphoto._get_collection()
+        shadow = live.database[f"{live.name}{SHADOW_SUFFIX}"]
+        shadow.drop()  # Left over from an interrupted rebuild
+        batch = []
+        count = 0
+        for nodes in self.walk(self.root):
+            batch += [node.to_mongo() for node in nodes]
+            if len(batch) >= INSERT_BATCH:
+                shadow.insert_many(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            shadow.insert_many(batch, ordered=False)
+            count += len(batch)
+        logger.info(f"Loaded {count} nodes into {shadow.name}; building indexes")
+        for fields in Gphoto.list_indexes():
+            if fields != [("_id", 1)]:  # Every collection has that one already
+                shadow.create_index(fields)
+        shadow.rename(live.name, dropTarget=True)
+        logger.info(f"Swapped {shadow.name} in as {live.name}")
+        self.save_start_token(start_token)
         self.database_clean(set_state=True)
-        logger.info(f"Full resync elapsed time: {datetime.datetime.now() - start_time}")
+        logger.info(f"Full resync of {count} nodes elapsed time: {datetime.datetime.now() - start_time}")
 
     def get_root(self):
-        root_id = service.files().get(fileId="root").execute().get("id")
-        assert root_id is not None, "No root ID found for Google Drive"
-        node_dict = self.steralize(
-            service.files()
-            .list(
-                q=f"parents in '{root_id}' and trashed = false and name = 'google photos'",
-                fields=INIT_FIELDS,
-            )
-            .execute()
-            .get("files")[0]
+        files = self.service().files()
+        responses, errors = self.execute_batch(
+            {
+                "root": files.get(fileId="root"),
+                # 'root' is Drive's alias for the root folder's ID, so both requests go in one batch
+                "photos": files.list(
+                    q="'root' in parents and trashed = false and name = 'google photos'", fields=INIT_FIELDS
+                ),
+            }
         )
+        if errors:
+            raise next(iter(errors.values()))
+        assert responses["root"].get("id") is not None, "No root ID found for Google Drive"
+        node_dict = self.steralize(responses["photos"].get("files")[0])
         root = Gphoto(**node_dict)
         Gphoto.objects(gid=root.gid).update(upsert=True, **node_dict)
         return root
 
-    def walk(self, folder, path=None):
-        path = path or []
-        folders = []
-        db_nodes = []
-        path.append(folder.name)
-        logger.info(f"Path: {path}")
-        for node in self.get_nodes(folder):
-            node.path = path
-            if node.mimeType == FOLDER:
-                folders.append(node)
-            db_nodes.append(node)
-        if db_nodes:
-            Gphoto.objects.insert(db_nodes)
+    def walk(self, root):
+        """
+        Breadth-first walk of the folder tree under root, yielding each folder's children, with their
+        paths set, as its listing completes. Up to self.workers folders are listed at once from a
+        shared frontier, so the walk is bound by API quota rather than by one round trip after another.
+        """
+        frontier = deque([root])
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while frontier or in_flight:
+                while frontier and len(in_flight) < self.workers:
+                    # Spread the frontier over the free workers, in batches of up to BATCH_LIMIT folders
+                    share = -(-len(frontier) // (self.workers - len(in_flight)))
+                    folders = [frontier.popleft() for _ in range(min(share, BATCH_LIMIT))]
+                    in_flight.add(pool.submit(self.list_folders, folders))
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for folder, nodes in future.result():
+                        path = (folder.path or []) + [folder.name]
+                        for node in nodes:
+                            node.path = path
+                            if node.mimeType == FOLDER:
+                                frontier.append(node)
+                        logger.info(f"Path: {path} ({len(frontier)} folders waiting)")
+                        yield nodes
+
+    def list_folders(self, folders):
+        """
+        [(folder, child nodes)] for folders. The first page of every folder is requested in one batch
+        HTTP request; the few folders with more than a page go on to page through the rest one by one.
+        """
+        if len(folders) == 1:
+            return [(folders[0], self.get_nodes(folders[0]))]
+        files = self.service().files()
+        requests = {
+            folder.gid: files.list(q=NODE_QUERY.format(folder.gid), pageSize=1000, fields=INIT_FIELDS)
+            for folder in folders
+        }
+        responses, errors = self.execute_batch(requests)
+        if errors:
+            raise next(iter(errors.values()))
+        listed = []
         for folder in folders:
-            self.walk(folder, path)
-        path.pop()
+            response = responses[folder.gid]
+            nodes = [Gphoto(**self.steralize(x)) for x in response["files"]]
+            if response.get("nextPageToken"):
+                nodes += self.get_nodes(folder, page_token=response["nextPageToken"])
+            listed.append((folder, nodes))
+        logger.info(f"Drive delivered {sum(len(nodes) for _, nodes in listed)} files from {len(folders)} folders")
+        return listed
+
+    def execute(self, request):
+        """request.execute(), rate limited and retried by self.api."""
+        return self.api.call(request.execute)
+
+    def execute_batch(self, requests):
+        """
+        Execute requests, a dict of key to Drive API request, as batch HTTP requests of up to
+        BATCH_LIMIT each. Each request in a batch counts against the quota, and those that fail on their
+        own with a throttling or server error are batched again after self.api's backoff.
+        Returns ({key: response}, {key: HttpError}).
+        """
+        keys = list(requests)
+        responses = {}
+        errors = {}
+
+        def callback(request_id, response, exception):
+            key = keys[int(request_id)]
+            if exception is not None:
+                errors[key] = exception
+            else:
+                responses[key] = response
 
-    def get_nodes(self, parent):
+        pending = list(range(len(keys)))
+        attempt = 0
+        while pending:
+            for start in range(0, len(pending), BATCH_LIMIT):
+                chunk = pending[start:start + BATCH_LIMIT]
+                batch = self.service().new_batch_http_request(callback=callback)
+                for i in chunk:
+                    batch.add(requests[keys[i]], request_id=str(i))
+                self.api.call(batch.execute, cost=len(chunk))
+            delays = {i: self.api.retry(errors[keys[i]], attempt) for i in pending if keys[i] in errors}
+            pending = [i for i, delay in delays.items() if delay is not None]
+            for i in pending:
+                del errors[keys[i]]
+            if pending:
+                time.sleep(max(delays[i] for i in pending))
+            attempt += 1
+        return responses, errors
+
+    def get_nodes(self, parent, page_token=None):
         cumulative = 0
         nodes = []
-        nextpagetoken = None
-        query = f"'{parent.gid}' in parents and (mimeType contains 'image/' or mimeType contains 'video/' or mimeType = 'application/vnd.google-apps.folder') and trashed = false"
+        nextpagetoken = page_token
+        query = NODE_QUERY.format(parent.gid)
         while True:
             start_time = datetime.datetime.now()
-            response = (
-                service.files()
-                .list(
-                    q=query, pageSize=1000, pageToken=nextpagetoken, fields=INIT_FIELDS
-                )
-                .execute()
+            response = self.execute(
+                self.service().files().list(q=query, pageSize=1000, pageToken=nextpagetoken, fields=INIT_FIELDS)
             )
             elapsed = datetime.datetime.now() - start_time
             count = len(response["files"])
@@ -108,14 +300,12 @@ class GphotoSync:
     # noinspection PyMethodMayBeStatic
     def start_token(self, update=False):
         if update:
-            start_token = service.changes().getStartPageToken().execute()
-            Gphoto_state.objects().update_one(
-                upsert=True, start_token=start_token["startPageToken"]
-            )
+            start_token = self.execute(self.service().changes().getStartPageToken())
+            self.save_start_token(start_token["startPageToken"])
             return start_token
         else:
             try:
-                start_token = Gphoto_state.objects().get().start_token
+                start_token = GphotoState.objects().get().start_token
             except me.MultipleObjectsReturned:
                 raise me.MultipleObjectsReturned(
                     "More than one record in State. Should never happen"
@@ -125,7 +315,11 @@ class GphotoSync:
             return start_token
 
     # noinspection PyMethodMayBeStatic
-    def get_google_drive_changes(self):
+    def save_start_token(self, start_token):
+        GphotoState.objects().update_one(upsert=True, start_token=start_token)
+
+    # noinspection PyMethodMayBeStatic
+    def get_google_drive_changes(self, page_token):
         """
         Google API for changes().list() returns:
         {
@@ -150,28 +344,22 @@ class GphotoSync:
             "teamDrive": teamdrives Resource
         }
 
+        Yields (changes, token) a page at a time from page_token on, where token is where the feed
+        continues after the page: its nextPageToken, or on the last page the newStartPageToken.
         """
-        change_token = Gphoto_state.objects().get()["start_token"]
-        changes = []
-        while True:
-            response = (
-                service.changes()
-                .list(
-                    pageToken=change_token,
+        while page_token is not None:
+            response = self.execute(
+                self.service().changes().list(
+                    pageToken=page_token,
                     pageSize=1000,
                     includeRemoved=True,
                     fields=UPDATE_FIELDS,
                 )
-                .execute()
             )
-            logger.info(
-                f"Google sent {len(response.get('changes', []))} change records"
-            )
-            changes += response["changes"]
-            change_token = response.get("nextPageToken")
-            if change_token is None:
-                break
-        return changes
+            changes = response.get("changes", [])
+            logger.info(f"Google sent {len(changes)} change records")
+            page_token = response.get("nextPageToken")
+            yield changes, page_token or response.get("newStartPageToken")
 
     @dataclass
     class DriveChange:
@@ -185,14 +373,21 @@ class GphotoSync:
         teamDriveId: str = None
         teamDrive: str = None
 
-    def validate_drive_changes(self):
-        drive_changes = self.get_google_drive_changes()
+    def validate_drive_changes(self, changes):
+        """
+        The changes to apply: removals, and photos and videos by MIME type and extension. Changed
+        folders update the folder index, and the paths of the photos kept are resolved, fetching
+        only the ancestor folders those photos need.
+        """
         valid_changes = []
-        for change in drive_changes:
-            drive_change = self.DriveChange(**change)
+        for drive_change in (self.DriveChange(**change) for change in changes):
             if drive_change.removed:
+                self.folder_index.remove(drive_change.fileId)
+                valid_changes.append(drive_change)
                 continue
             drive_change.gphoto = Gphoto(**self.steralize(drive_change.file))
+            if drive_change.gphoto.mimeType == FOLDER:
+                self.folder_index.add(drive_change.gphoto)
             if not any(
                 [mimeType in drive_change.gphoto.mimeType for mimeType in MIME_FILTER]
             ):
@@ -203,58 +398,71 @@ class GphotoSync:
             ):
                 continue
             drive_change.removed = drive_change.removed or drive_change.gphoto.trashed
-            drive_change.gphoto.path = self.get_node_path(drive_change.gphoto)
             valid_changes.append(drive_change)
+        kept = [change.gphoto for change in valid_changes if not change.removed]
+        self.fetch_missing_folders(kept)
+        for gphoto in kept:
+            gphoto.path = self.folder_index.node_path(gphoto)
         return valid_changes
 
-    def update_db(self):
-        drive_changes = self.validate_drive_changes()
-        if not drive_changes:
-            logger.info("No changes to photos detected")
-            return
-        delete_count = new_count = 0
-        self.database_clean(set_state=False)
-        for change in drive_changes:
-            if change.removed:
-                Gphoto.objects(gid=change.fileId).delete()
-                logger.info(
-                    f"Removing record for file ID {change.fileId} from database if it exists."
-                )
-                delete_count += 1
-            else:
-                try:
-                    Gphoto.objects(gid=change.gphoto.gid).get()
-                except me.DoesNotExist:
-                    logger.info(f"Updating record {change.gphoto.name}")
-                    change.gphoto.save(force_insert=False)
-                    new_count += 1
-                    continue
-                else:
-                    logger.info(f"Update skipped; Google ID already in database")
-        self.database_clean(set_state=True)
+    def update_db(self, overwrite=False):
+        """
+        Apply the change feed from the saved start token a page at a time, saving the token for the next
+        page once a page has been written. Only one page is held in memory, and an interrupted sync
+        resumes at the page it was on; applying part of a page again is harmless, since the writes are
+        upserts and deletes. The last page leaves Drive's newStartPageToken saved for the next sync.
+        :param overwrite: Update records that already exist in place ($set) instead of leaving them as
+            they are ($setOnInsert)
+        """
+        self.folder_index = FolderIndex.load(self.root.gid, self.root.name)
+        totals = Counter()
+        for changes, next_token in self.get_google_drive_changes(self.start_token()):
+            drive_changes = self.validate_drive_changes(changes)
+            if drive_changes:
+                totals.update(self.apply_changes(drive_changes, overwrite))
+            if next_token:
+                self.save_start_token(next_token)
         logger.info(
-            f"Sync update complete. New file count: {new_count} Deleted file count: {delete_count}"
+            f"Sync update complete. New file count: {totals['upserted']} Updated file count: {totals['modified']} "
+            f"Deleted file count: {totals['deleted']}"
         )
 
-    @functools.lru_cache()
-    def get_node_path(self, node):
-        assert len(node.parents) > 0, "Got node with no parents"
-        if node.parents[0] == self.root.gid:
-            return []
-        try:
-            parent = Gphoto.objects(gid=node.parents[0]).get()
-        except me.MultipleObjectsReturned as e:
-            logger.warning(
-                f"Wrong number of records returned for {node.gid}. Error {e}"
-            )
-            return ["*MultiParents*"]
-        except me.DoesNotExist as e:
-            logger.warning(f"Parent does not exist. Error {e}")
-            return []
-        if parent.path:
-            return parent.path + [parent.name]
-        else:
-            return self.get_node_path(parent) + [parent.name]
+    # noinspection PyMethodMayBeStatic
+    def apply_changes(self, drive_changes, overwrite=False):
+        """
+        Apply drive_changes with unordered bulk writes: an upsert keyed on gid for each changed file and
+        DeleteMany with $in for removed ones. Only the last change to each file is applied, so it doesn't
+        matter that the server may apply the operations out of order. Returns the BulkWriter counts.
+        """
+        latest = {change.fileId: change for change in drive_changes}
+        removed = [gid for gid, change in latest.items() if change.removed]
+        with BulkWriter(Gphoto._get_collection()) as writer:
+            for start in range(0, len(removed), WRITE_BATCH_SIZE):
+                writer.add(DeleteMany({"gid": {"$in": removed[start:start + WRITE_BATCH_SIZE]}}))
+            for change in latest.values():
+                if not change.removed:
+                    writer.add(gphoto_upsert(change.gphoto, overwrite))
+        return writer.counts
+
+    def fetch_missing_folders(self, nodes):
+        """
+        Add the ancestors of nodes that self.folder_index doesn't have, fetched from Drive a level at a
+        time in batch requests rather than one get per folder, so the paths of nodes resolve.
+        """
+        wanted = {node.parents[0] for node in nodes if node.parents} - {self.root.gid}
+        while wanted:
+            wanted = {gid for gid in wanted if gid not in self.folder_index}
+            if not wanted:
+                return
+            files = self.service().files()
+            responses, errors = self.execute_batch({gid: files.get(fileId=gid, fields=FILE_FIELDS) for gid in wanted})
+            for gid, e in errors.items():
+                logger.warning(f"Can't fetch folder {gid}: {e}")
+            fetched = [Gphoto(**self.steralize(response)) for response in responses.values()]
+            logger.info(f"Fetched {len(fetched)} folders missing from the database")
+            for folder in fetched:
+                self.folder_index.add(folder)
+            wanted = {folder.parents[0] for folder in fetched if folder.parents} - {self.root.gid}
 
     # noinspection PyMethodMayBeStatic
     def steralize(self, node):
@@ -269,7 +477,7 @@ class GphotoSync:
     def database_clean(self, set_state=None):
         if set_state is None:
             try:
-                db_clean = Gphoto_state.objects().get().database_clean
+                db_clean = GphotoState.objects().get().database_clean
             except me.MultipleObjectsReturned:
                 raise me.MultipleObjectsReturned(
                     "State database has more than one record - should never happen."
@@ -279,7 +487,7 @@ class GphotoSync:
             return db_clean
         else:
             assert isinstance(set_state, bool), "State must be boolean."
-            Gphoto_state.objects().update_one(upsert=True, database_clean=set_state)
+            GphotoState.objects().update_one(upsert=True, database_clean=set_state)
             return set_state
 
 
@@ -1,3 +1,4 @@
+from dedup import find_duplicates
 from me_models import DbConnect, Queue
 from utils import config
 from loguru import logger
@@ -83,4 +84,11 @@ for n, p in enumerate(Queue.objects):
             print(f"Value error! {n}: {t} {t.encode()} {e} {p.src_path}")
 print(f"Done! {n} photos checked")
 
-
+candidates = (
+    (p["src_path"], p["size"])
+    for p in Queue.objects(size__ne=None, purged__ne=True).only("src_path", "size").as_pymongo()
+)
+for md5sum, paths in find_duplicates(candidates):
+    print(f'------------ {md5sum}')
+    for path in paths:
+        print(path)
@@ -0,0 +1,172 @@
+import struct
+from dataclasses import dataclass
+
+import arrow
+from loguru import logger
+
+HEADER_BYTES = 64 * 1024
+JPEG_MAGIC = b'\xff\xd8'
+TIFF_MAGIC = (b'II*\x00', b'MM\x00*')
+EXIF_MAGIC = b'Exif\x00\x00'
+
+APP1 = 0xE1
+START_OF_SCAN = 0xDA
+END_OF_IMAGE = 0xD9
+START_OF_FRAME = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+STANDALONE = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+MAKE = 0x010F
+MODEL = 0x0110
+DATETIME = 0x0132
+DATETIME_ORIGINAL = 0x9003
+IMAGE_WIDTH = 0x0100
+IMAGE_LENGTH = 0x0101
+EXIF_IFD = 0x8769
+IFD0_TAGS = {MAKE, MODEL, DATETIME, IMAGE_WIDTH, IMAGE_LENGTH, EXIF_IFD}
+EXIF_TAGS = {DATETIME_ORIGINAL}
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+MAX_IFD_ENTRIES = 1000  # More than this means we're reading garbage
+
+
+@dataclass
+class ExifHeader:
+    make: str = ''
+    model: str = ''
+    datetime: str = ''
+    datetime_original: str = ''
+    width: int = 0
+    height: int = 0
+
+
+class _FileSource:
+    def __init__(self, fp):
+        self.fp = fp
+
+    def read(self, offset, size):
+        self.fp.seek(offset)
+        return self.fp.read(size)
+
+
+class _BufferSource:
+    def __init__(self, buf):
+        self.buf = buf
+
+    def read(self, offset, size):
+        return bytes(self.buf[offset:offset + size])
+
+
+def read_exif_header(path) -> ExifHeader:
+    """
+    Read camera make/model, DateTime, DateTimeOriginal and pixel size from the JPEG APP1 and frame
+    header or the TIFF IFDs, without reading or decoding the image data.
+    """
+    with open(path, 'rb', buffering=HEADER_BYTES) as fp:
+        return _parse(_FileSource(fp))
+
+
+def parse_exif_header(buf) -> ExifHeader:
+    """read_exif_header for a file already in memory (bytes, mmap or memoryview)."""
+    return _parse(_BufferSource(buf))
+
+
+def _parse(source) -> ExifHeader:
+    magic = source.read(0, 4)
+    result = ExifHeader()
+    if magic[:2] == JPEG_MAGIC:
+        _parse_jpeg(source, result)
+    elif magic in TIFF_MAGIC:
+        _parse_tiff(source, result)
+    return result
+
+
+def _parse_jpeg(source, result):
+    offset = 2
+    while True:
+        marker = source.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return
+        code = marker[1]
+        if code == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if code in STANDALONE:
+            offset += 2
+            continue
+        if code in (START_OF_SCAN, END_OF_IMAGE):
+            return
+        length = struct.unpack('>H', marker[2:4])[0]
+        if code == APP1 and not result.make and not result.datetime:
+            segment = source.read(offset + 4, length - 2)
+            if segment.startswith(EXIF_MAGIC):
+                _parse_tiff(_BufferSource(segment[len(EXIF_MAGIC):]), result)
+        elif code in START_OF_FRAME:
+            frame = source.read(offset + 4, 5)
+            if len(frame) == 5:
+                result.height, result.width = struct.unpack('>HH', frame[1:5])
+            return  # The frame header follows all APPn segments
+        offset += 2 + length
+
+
+def _parse_tiff(source, result):
+    header = source.read(0, 8)
+    if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+        return
+    endian = '<' if header[:2] == b'II' else '>'
+    ifd0 = _read_ifd(source, struct.unpack(endian + 'I', header[4:8])[0], endian, IFD0_TAGS)
+    result.make = ifd0.get(MAKE, '')
+    result.model = ifd0.get(MODEL, '')
+    result.datetime = ifd0.get(DATETIME, '')
+    if not result.width:
+        result.width = ifd0.get(IMAGE_WIDTH, 0)
+        result.height = ifd0.get(IMAGE_LENGTH, 0)
+    if ifd0.get(EXIF_IFD):
+        exif = _read_ifd(source, ifd0[EXIF_IFD], endian, EXIF_TAGS)
+        result.datetime_original = exif.get(DATETIME_ORIGINAL, '')
+
+
+def _read_ifd(source, offset, endian, wanted):
+    values = {}
+    count = source.read(offset, 2)
+    if len(count) < 2:
+        return values
+    count = struct.unpack(endian + 'H', count)[0]
+    if count > MAX_IFD_ENTRIES:
+        return values
+    entries = source.read(offset + 2, 12 * count)
+    for i in range(len(entries) // 12):
+        tag, kind, n, value = struct.unpack(endian + 'HHI4s', entries[12 * i:12 * i + 12])
+        if tag not in wanted:
+            continue
+        if kind == ASCII:
+            data = value[:n] if n <= 4 else source.read(struct.unpack(endian + 'I', value)[0], n)
+            values[tag] = _ascii(data)
+        elif kind == SHORT:
+            values[tag] = struct.unpack(endian + 'H', value[:2])[0]
+        elif kind == LONG:
+            values[tag] = struct.unpack(endian + 'I', value)[0]
+    return values
+
+
+def _ascii(data):
+    # Some cameras pad with NULs followed by junk; everything after the first NUL is dropped
+    return data.split(b'\x00', 1)[0].decode('utf-8', errors='replace').strip()
+
+
+def exif_datetime(datestring):
+    """Parse an EXIF date string, tolerating the stray characters and binary some cameras write."""
+    if not datestring:
+        return None
+    t = "".join(
+        [x for x in datestring if x in "0123456789:/ "]
+    )  # Strip extraneous characters and binary
+    try:
+        converted = arrow.get(
+            t, ["YYYY:MM:DD HH:mm:ss", "YYYY:MM:DD HH:mm", "DD/MM/YYYY"]
+        )
+        return converted.datetime
+    except ValueError as e:
+        logger.warning(f"Value error: Datestring: {t} Binary equiv: {t.encode()} {e}")
+        return None
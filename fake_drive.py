@@ -0,0 +1,153 @@
+import itertools
+import re
+import threading
+from collections import Counter
+
+from googleapiclient.errors import HttpError
+
+FOLDER = "application/vnd.google-apps.folder"
+PHOTOS_QUERY = "'root' in parents and trashed = false and name = 'google photos'"
+
+
+class FakeRequest:
+    def __init__(self, drive, name, fn):
+        self.drive = drive
+        self.name = name
+        self.fn = fn
+
+    def execute(self):
+        self.drive.count("round_trips")
+        return self.run()
+
+    def run(self):
+        self.drive.count(self.name)
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        assert len(self.requests) <= 100, "Drive allows at most 100 requests in a batch"
+        self.drive.count("round_trips")
+        self.drive.count("batched", len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+class FakeResource:
+    def __init__(self, drive, kind):
+        self.drive = drive
+        self.kind = kind
+
+    def get(self, fileId, fields=None):
+        return FakeRequest(self.drive, "files.get", lambda: self.drive.get(fileId))
+
+    def list(self, q=None, fields=None, pageSize=100, pageToken=None, **kwargs):
+        if self.kind == "changes":
+            return FakeRequest(self.drive, "changes.list", lambda: self.drive.list_changes(pageToken, pageSize))
+        return FakeRequest(self.drive, "files.list", lambda: self.drive.list_files(q, pageSize, pageToken))
+
+    def getStartPageToken(self):
+        return FakeRequest(self.drive, "changes.getStartPageToken", lambda: {"startPageToken": str(len(self.drive.change_log))})
+
+
+class FakeDrive:
+    """
+    In-memory stand-in for the Drive v3 service, for running GphotoSync offline: files().get and list
+    (with the queries GphotoSync sends, and paging), changes().getStartPageToken and list, and batch
+    HTTP requests. Pass service_factory=lambda: drive. counts tallies requests by method, and
+    round_trips the HTTP requests they took, a batch counting as one.
+    """
+
+    def __init__(self, page_size=1000):
+        self.page_size = page_size
+        self.nodes = {"root": dict(id="root", name="My Drive", mimeType=FOLDER, parents=[])}
+        self.change_log = []
+        self.counts = Counter()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def files(self):
+        return FakeResource(self, "files")
+
+    def changes(self):
+        return FakeResource(self, "changes")
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def add(self, name, parent, mimeType="image/jpeg", size=1000):
+        """Create a file (a folder for mimeType FOLDER) under parent and record the change; returns its id."""
+        gid = f"id{next(self.ids)}"
+        self.nodes[gid] = dict(id=gid, name=name, mimeType=mimeType, parents=[parent], trashed=False)
+        if mimeType != FOLDER:
+            self.nodes[gid]["size"] = size
+        self.change_log.append(dict(fileId=gid, removed=False, file=dict(self.nodes[gid])))
+        return gid
+
+    def add_folder(self, name, parent):
+        return self.add(name, parent, mimeType=FOLDER)
+
+    def remove(self, gid):
+        del self.nodes[gid]
+        self.change_log.append(dict(fileId=gid, removed=True))
+
+    def get(self, gid):
+        if gid not in self.nodes:
+            raise HttpError(FakeResponse(404), b"File not found")
+        return dict(self.nodes[gid])
+
+    def list_files(self, q, page_size, page_token):
+        if q == PHOTOS_QUERY:
+            nodes = [n for n in self.children("root") if n["name"].lower() == "google photos"]
+        else:
+            parent = re.match(r"'([^']+)' in parents", q).group(1)
+            nodes = [
+                n for n in self.children(parent)
+                if n["mimeType"] == FOLDER or n["mimeType"].startswith(("image/", "video/"))
+            ]
+        return self.page("files", nodes, page_size, page_token)
+
+    def list_changes(self, page_token, page_size):
+        response = self.page("changes", self.change_log[int(page_token):], page_size, None)
+        if "nextPageToken" in response:
+            response["nextPageToken"] = str(int(page_token) + int(response["nextPageToken"]))
+        else:
+            response["newStartPageToken"] = str(len(self.change_log))
+        return response
+
+    def children(self, parent):
+        return [dict(n) for n in self.nodes.values() if parent in n["parents"] and not n.get("trashed")]
+
+    def page(self, key, items, page_size, page_token):
+        start = int(page_token or 0)
+        size = min(page_size, self.page_size)
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response["nextPageToken"] = str(start + size)
+        return response
+
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = "Not Found"
@@ -0,0 +1,118 @@
+import os.path
+import queue
+import threading
+from typing import Iterable, Iterator, Optional, Set
+
+from loguru import logger
+
+from stat_manifest import ADDED, CHANGED, StatManifest
+from tree_walk import walk
+
+try:
+    from watchdog.observers import Observer
+except ImportError:  # Fall back to polling the stat manifest
+    Observer = None
+
+WATCH_MANIFEST_PATH = "watch_manifest.sqlite"
+DEBOUNCE_SECONDS = 0.5
+POLL_SECONDS = 30
+
+
+class DirectoryWatcher:
+    """
+    Collects files created, modified or moved into the watched directories and hands them out in
+    debounced batches, so a burst of writes (a camera dump, a file still being copied) becomes a
+    single batch once the directories have been quiet for DEBOUNCE_SECONDS.
+
+    Uses filesystem change notifications when watchdog is installed. Otherwise a background thread
+    rescans the directories against a stat manifest every POLL_SECONDS.
+    """
+
+    def __init__(self, paths: Iterable[str], extensions: Optional[Iterable[str]] = None, poll=None):
+        self.paths = [str(p) for p in paths]
+        self.extensions = set(extensions) if extensions is not None else None
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+        self.poll = Observer is None if poll is None else poll
+        self.observer = None
+        self.poller = None
+        self.primed = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        if self.poll:
+            logger.info(f"Polling {self.paths} for changes every {POLL_SECONDS} seconds")
+            self.poller = threading.Thread(target=self._poll, daemon=True)
+            self.poller.start()
+            # Files created from here on must be reported, so wait for the scan changes are measured from
+            self.primed.wait()
+        else:
+            logger.info(f"Watching {self.paths} for changes")
+            self.observer = Observer()
+            for path in self.paths:
+                self.observer.schedule(self, path, recursive=True)
+            self.observer.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.events.put(None)
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.poller is not None:  # So a new watcher's poller never shares the manifest with this one
+            self.poller.join()
+
+    def batches(self, timeout=None) -> Iterator[Set[str]]:
+        """
+        Yield sets of touched file paths. Blocks without polling until an event arrives; yields an
+        empty set if nothing arrives within timeout seconds.
+        :param timeout: Seconds to wait for the first event of a batch; None waits indefinitely
+        """
+        while not self.stopped.is_set():
+            try:
+                path = self.events.get(timeout=timeout)
+            except queue.Empty:
+                yield set()
+                continue
+            batch = set()
+            while path is not None:
+                batch.add(path)
+                try:
+                    path = self.events.get(timeout=DEBOUNCE_SECONDS)
+                except queue.Empty:
+                    break
+            if batch:
+                yield batch
+
+    def dispatch(self, event):
+        """watchdog event handler entry point"""
+        if event.is_directory or event.event_type not in ("created", "modified", "moved", "closed"):
+            return
+        self._touched(getattr(event, "dest_path", None) or event.src_path)
+
+    def _touched(self, path):
+        if self.extensions is None or os.path.splitext(path)[1].lower() in self.extensions:
+            self.events.put(path)
+
+    def _poll(self):
+        # Like change notifications, only report changes made after the watcher started
+        try:
+            with StatManifest(WATCH_MANIFEST_PATH) as manifest:
+                while not self.stopped.is_set():
+                    for top in self.paths:
+                        unscanned = []
+                        records = walk([top], extensions=self.extensions, unscanned=unscanned)
+                        for change in manifest.rescan(top, records, unscanned):
+                            if self.primed.is_set() and change.kind in (ADDED, CHANGED):
+                                self.events.put(change.path)
+                        manifest.commit(top)
+                    self.primed.set()
+                    self.stopped.wait(POLL_SECONDS)
+        finally:
+            self.primed.set()  # Don't leave start() waiting if polling fails
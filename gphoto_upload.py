@@ -5,9 +5,12 @@ import os.path
 from pprint import pformat
 from oauth2creds import get_credentials
 from loguru import logger
+from rate_limit import scheduler
 
 cfg = utils.config()
 logger.add("gphoto_upload.log", rotation="1 MB")
+upload_api = scheduler("photos_upload")
+photos_api = scheduler("photos")
 
 
 def upload_to_gphotos(filepath, filename=None):
@@ -33,7 +36,7 @@ def _upload_binary_media(filepath, filename):
         "X-Goog-Upload-File-Name": f"{filename}",
         "X-Goog-Upload-Protocol": "raw",
     }
-    r = requests.post(url, headers=headers, data=binary_file)
+    r = upload_api.call(requests.post, url, headers=headers, data=binary_file)
     if r.ok:
         log_status = "Upload successful"
     else:
@@ -49,7 +52,10 @@ def _insert_new_photo(token):
         "newMediaItems": [{"simpleMediaItem": {"uploadToken": token}}]
     }
     url = r"https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate"
-    r = requests.post(url=url, headers=headers, data=json.dumps(insert_new_media_item))
+    # Not idempotent: a batchCreate retried after a 5xx or a dropped connection may add the item twice
+    r = photos_api.call(
+        requests.post, url=url, headers=headers, data=json.dumps(insert_new_media_item), idempotent=False
+    )
     response = r.json()
     status = response["newMediaItemResults"][0]["status"]["message"]
     if status != "OK":
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from loguru import logger
+
+from utils import file_md5sum
+
+HASH_CACHE_PATH = "hash_cache.sqlite"
+MAX_ENTRIES = 5_000_000
+EVICT_CHECK_INTERVAL = 10_000  # puts between checks of the entry count
+TOUCH_SECONDS = 24 * 3600  # A hit only rewrites last_used if it is older than this
+
+
+class CachedHashes(NamedTuple):
+    md5sum: Optional[str]
+    image_md5: Optional[str]
+
+
+NO_HASHES = CachedHashes(None, None)
+
+
+class HashCache:
+    """
+    Persistent cache of file and pixel MD5s keyed on (device, inode, size, mtime_ns).
+
+    Any write to a file changes its size or mtime and so its key; a stale entry is simply never hit
+    again and ages out under the least-recently-used eviction once the cache holds more than
+    max_entries. last_used is kept to within TOUCH_SECONDS, so most hits are reads only.
+    invalidate() drops the entries for a path explicitly.
+    """
+
+    def __init__(self, db_path=HASH_CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                path TEXT,
+                md5sum TEXT,
+                image_md5 TEXT,
+                last_used REAL,
+                PRIMARY KEY (dev, inode, size, mtime_ns)
+            );
+            CREATE INDEX IF NOT EXISTS hashes_path ON hashes(path);
+            CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes(last_used);
+            """
+        )
+
+    def close(self):
+        self.db.close()
+
+    def get(self, st: os.stat_result) -> Optional[CachedHashes]:
+        key = stat_key(st)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT md5sum, image_md5, last_used FROM hashes WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - (row[2] or 0) > TOUCH_SECONDS:
+                self.db.execute(
+                    "UPDATE hashes SET last_used = ? WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                    (now, *key),
+                )
+                self.db.commit()
+        return CachedHashes(*row[:2])
+
+    def put(self, st: os.stat_result, path, md5sum=None, image_md5=None):
+        """Record hashes for the file whose stat is st; a None hash keeps any value already cached."""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (dev, inode, size, mtime_ns) DO UPDATE SET path = excluded.path, "
+                "md5sum = coalesce(excluded.md5sum, md5sum), image_md5 = coalesce(excluded.image_md5, image_md5), "
+                "last_used = excluded.last_used",
+                (*stat_key(st), str(path), md5sum, image_md5, time.time()),
+            )
+            self.db.commit()
+            self.puts += 1
+            if self.puts % EVICT_CHECK_INTERVAL == 0:
+                self._evict()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM hashes WHERE path = ?", (str(path),))
+            self.db.commit()
+
+    def _evict(self):
+        count = self.db.execute("SELECT count(*) FROM hashes").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self.db.commit()
+            logger.info(f"Hash cache evicted {excess} least recently used entries")
+
+
+def stat_key(st: os.stat_result):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+_cache = None
+
+
+def hash_cache() -> HashCache:
+    """Per-process cache; a forked worker opens its own connection."""
+    global _cache
+    if _cache is None or _cache.pid != os.getpid():
+        _cache = HashCache()
+    return _cache
+
+
+def put_if_unchanged(st: os.stat_result, path, md5sum=None, image_md5=None):
+    """
+    hash_cache().put the hashes of the file at path, read when its stat was st, unless it has changed
+    or gone since: its hashes may be of neither version.
+    """
+    try:
+        unchanged = stat_key(os.stat(path)) == stat_key(st)
+    except OSError:
+        unchanged = False
+    if unchanged:
+        hash_cache().put(st, path, md5sum=md5sum, image_md5=image_md5)
+
+
+def cached_md5(path) -> str:
+    """MD5 of the file at path, reading the file only if the cache has no entry for its current stat."""
+    st = os.stat(path)
+    cached = hash_cache().get(st) or NO_HASHES
+    if cached.md5sum:
+        return cached.md5sum
+    md5sum = file_md5sum(path)
+    put_if_unchanged(st, path, md5sum=md5sum)
+    return md5sum
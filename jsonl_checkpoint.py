@@ -0,0 +1,96 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+CHECKPOINT_SUFFIX = ".checkpoint.sqlite"
+
+
+class JsonlCheckpoint:
+    """
+    Indexed record of the paths already written to a JSONL sink, kept next to it as
+    <sink>.checkpoint.sqlite along with the sink offset up to which those paths are known to be durable.
+
+    On open, only the part of the sink beyond the committed offset is read: complete lines there (written
+    and synced before a crash, but not yet committed here) are indexed, and a partial final line is
+    truncated away so it is rewritten rather than duplicated. Startup cost therefore depends on how much
+    was lost in the last crash, not on the size of the sink. An existing sink without a checkpoint is
+    indexed once in full.
+    """
+
+    def __init__(self, sink_path):
+        self.sink_path = Path(sink_path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(f"{self.sink_path}{CHECKPOINT_SUFFIX}", check_same_thread=False)
+        self.db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS done (path TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            """
+        )
+        self.reconcile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __contains__(self, path):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM done WHERE path = ?", (str(path),)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM done").fetchone()[0]
+
+    @property
+    def offset(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+        return row[0] if row else 0
+
+    def commit(self, offset, paths):
+        """Record paths as written and the sink as synced up to offset, in one transaction."""
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO done VALUES (?)", ((str(p),) for p in paths))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('offset', ?)", (offset,))
+
+    def reconcile(self):
+        if not self.sink_path.is_file():
+            if self.offset:
+                logger.warning(f"{self.sink_path} is gone; clearing its checkpoint")
+            self._reset()
+            return
+        offset = self.offset
+        if os.path.getsize(self.sink_path) < offset:
+            logger.warning(f"{self.sink_path} is shorter than its checkpoint; re-indexing it")
+            self._reset()
+            offset = 0
+        paths = []
+        with self.sink_path.open("r+b") as fp:
+            fp.seek(offset)
+            for line in iter(fp.readline, b""):
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Truncating partial line at {offset} in {self.sink_path}")
+                    fp.truncate(offset)
+                    break
+                try:
+                    paths.append(json.loads(line)["path"])
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Unreadable line at {offset} in {self.sink_path}: {e}")
+                offset += len(line)
+        self.commit(offset, paths)
+        if paths:
+            logger.info(f"Indexed {len(paths)} lines written after the last checkpoint of {self.sink_path}")
+
+    def _reset(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM done")
+            self.db.execute("DELETE FROM meta")
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import md5
+
+from loguru import logger
+
+from hash_cache import hash_cache, put_if_unchanged
+
+READ_SIZE = 8 * 1024 * 1024
+DEVICE_BYTES_PER_SECOND = 120e6
+LARGE_FILE_WORKERS = 2
+LARGE_FILE_BYTES = 100e6
+VIDEO_TYPES = ['.mov', '.mp4', '.avi']
+
+
+def is_large_file(path, size) -> bool:
+    """Files that go to the streaming hasher instead of the image workers."""
+    return size > LARGE_FILE_BYTES or os.path.splitext(path)[1].lower() in VIDEO_TYPES
+
+
+class IoBudget:
+    """
+    Token bucket of read bandwidth per device, shared by every thread hashing from that device, so
+    streaming multi-gigabyte videos can't saturate a disk the image workers are also reading from.
+    """
+
+    def __init__(self, bytes_per_second=DEVICE_BYTES_PER_SECOND):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = {}
+
+    def consume(self, dev, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free.get(dev, now))
+            self.next_free[dev] = start + nbytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+default_budget = IoBudget()
+
+
+def stream_md5(path, budget: IoBudget = default_budget) -> str:
+    """
+    MD5 of a file read sequentially in READ_SIZE blocks into one reused buffer, charged against the
+    device's I/O budget. Consults and fills the hash cache.
+    """
+    st = os.stat(path)
+    cached = hash_cache().get(st)
+    if cached and cached.md5sum:
+        return cached.md5sum
+    digest = md5()
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fp:
+        while True:
+            if budget is not None:
+                budget.consume(st.st_dev, READ_SIZE)
+            n = fp.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    md5sum = digest.hexdigest()
+    put_if_unchanged(st, path, md5sum=md5sum)
+    return md5sum
+
+
+class LargeFileHasher:
+    """
+    Thread pool for streaming hashes of large files and videos, kept apart from the image decoding
+    workers. hashlib releases the GIL while hashing large blocks, so threads hash in parallel.
+    """
+
+    def __init__(self, workers=LARGE_FILE_WORKERS, budget: IoBudget = default_budget):
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="large_file_hash")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, path) -> Future:
+        return self.executor.submit(self._hash, path)
+
+    def _hash(self, path):
+        start = time.monotonic()
+        md5sum = stream_md5(path, self.budget)
+        logger.info(f"Streamed MD5 of {path} in {time.monotonic() - start:.1f}s")
+        return md5sum
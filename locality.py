@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import deque
+
+from loguru import logger
+
+
+def locality_key(path):
+    """
+    Sort key approximating where a file sits on disk: device, then directory, then inode. Files written
+    together into one directory usually get neighbouring inodes and neighbouring data blocks.
+    """
+    path = str(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, os.path.dirname(path), 0
+    return st.st_dev, os.path.dirname(path), st.st_ino
+
+
+def locality_sorted(items, path=lambda item: item):
+    """items sorted by the locality_key of path(item)."""
+    return sorted(items, key=lambda item: locality_key(path(item)))
+
+
+class LocalityScheduler:
+    """
+    Work ordered by position on disk and spread over workers by device.
+
+    The items are ordered by key (locality_key of each item's path unless given; the first element must
+    be the device) into one sweep per device, and the workers are divided among the devices in
+    proportion to the work on each. Each device's sweep is cut into one contiguous region per worker on
+    it, sized by the share of workers, and each worker reads its own region front to back, so the head
+    crosses each region once instead of bouncing between chunks handed out in turn. A device left
+    without a worker is one unowned region, taken by the first worker to run out. When a worker's region
+    runs out and no unowned region is left, it steals the back half of the largest region left, on its
+    own device if there is one, so none sit idle at the tail of the run; steals counts only those.
+    """
+
+    def __init__(self, items, workers, key=None, path=lambda item: item):
+        key = key or (lambda item: locality_key(path(item)))
+        self.lock = threading.Lock()
+        sweeps = {}
+        for k, _, item in sorted((key(item), i, item) for i, item in enumerate(items)):
+            sweeps.setdefault(k[0], []).append(item)
+        assignment = []
+        for _ in range(max(1, workers)):
+            assignment.append(max(sweeps, key=lambda d: len(sweeps[d]) / (assignment.count(d) + 1), default=None))
+        self.regions = {}  # worker, or (device,) for a device no worker was given: (device, deque of items)
+        for dev, sweep in sweeps.items():
+            owners = [worker for worker, d in enumerate(assignment) if d == dev] or [(dev,)]
+            for i, owner in enumerate(owners):
+                region = sweep[len(sweep) * i // len(owners):len(sweep) * (i + 1) // len(owners)]
+                self.regions[owner] = dev, deque(region)
+        self.steals = 0
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(region) for _, region in self.regions.values())
+
+    def take(self, worker, n=1):
+        """Up to n next items for worker; an empty list once all the work is gone."""
+        with self.lock:
+            dev, region = self.regions.get(worker, (None, ()))
+            if not region:
+                unowned = [owner for owner, (_, left) in self.regions.items() if isinstance(owner, tuple) and left]
+                if unowned:
+                    owner = max(unowned, key=lambda owner: len(self.regions[owner][1]))
+                    logger.debug(f"Worker {worker} taking over device {owner[0]}")
+                    dev, region = self.regions[worker] = self.regions.pop(owner)
+                else:
+                    victim = max(
+                        (owner for owner in self.regions if owner != worker),
+                        key=lambda owner: (len(self.regions[owner][1]) > 1, self.regions[owner][0] == dev,
+                                           len(self.regions[owner][1])),
+                        default=None,
+                    )
+                    if victim is None or not self.regions[victim][1]:
+                        return []
+                    dev, left = self.regions[victim]
+                    # The back half, so the victim keeps reading on from where it is
+                    region = deque(left.pop() for _ in range(len(left) // 2 or len(left)))
+                    region.reverse()
+                    self.regions[worker] = dev, region
+                    logger.debug(f"Worker {worker} stealing {len(region)} items from worker {victim} on device {dev}")
+                    self.steals += 1
+            return [region.popleft() for _ in range(min(n, len(region)))]
@@ -1,7 +1,14 @@
 import mongoengine as me
+from loguru import logger
+from pymongo import DeleteMany
+from pymongo.errors import DuplicateKeyError
+
+from exif_header import exif_datetime
 from utils import config
 
 cfg = config()
+DEDUPE_BATCH = 1000  # Duplicate Queue documents deleted per DeleteMany
+INDEX_ATTEMPTS = 3
 
 
 class DbConnect:
@@ -21,6 +28,7 @@ class DbConnect:
             alias=cfg.source_archive.database,
             host=cfg.source_archive.host,
         )
+        ensure_queue_indexes()
 
 
 class Gphoto(me.Document):  # TODO: Remove strict: false from metadata once db is clean
@@ -37,7 +45,7 @@ class Gphoto(me.Document):  # TODO: Remove strict: false from metadata once db i
     path = me.ListField()
     meta = {
         "db_alias": cfg.gphotos.collection,
-        "indexes": ["gid", "md5Checksum"],
+        "indexes": ["gid", "md5Checksum", "mimeType"],
         "strict": False,
     }
 
@@ -56,6 +64,18 @@ class Src_metadata(me.EmbeddedDocument):
     width = me.IntField(default=0)
     height = me.IntField(default=0)
 
+    @classmethod
+    def from_image_metadata(cls, metadata):
+        """Build from a photo_file_metadata.ImageMetadata, parsing its EXIF date strings."""
+        return cls(
+            cameraMake=metadata.camera_make or None,
+            cameraModel=metadata.camera_model or None,
+            creationTime=exif_datetime(metadata.creation_time),
+            dateTimeOriginal=exif_datetime(metadata.datetime_original),
+            width=metadata.width,
+            height=metadata.height,
+        )
+
 
 class Photo(me.Document):
     src_path = me.StringField(default=None)
@@ -67,6 +87,8 @@ class Photo(me.Document):
     gid = me.StringField(default=None)
     in_gphotos = me.BooleanField(default=False)
     in_process = me.BooleanField(default=False)
+    lease_owner = me.StringField(default=None)  # Worker holding a queue_lease.QueueLease on this document
+    lease_expires = me.DateTimeField(default=None)
     mirrored = me.BooleanField(default=False)
     purged = me.BooleanField(default=False)
     # uploaded = me.BooleanField(default=False)
@@ -81,9 +103,80 @@ class Photo(me.Document):
     gphoto_meta = me.DictField(default=None)  # TODO:  Delete this?
     meta = {"allow_inheritance": True}
 
+    def apply_metadata(self, metadata):
+        """Copy hashes and source metadata from a photo_file_metadata.ImageMetadata."""
+        self.md5sum = metadata.md5sum or None
+        self.image_md5 = metadata.image_md5 or None
+        if metadata.width:
+            self.src_metadata = Src_metadata.from_image_metadata(metadata)
+
 
 class Queue(Photo):
-    meta = {"db_alias": cfg.local.database}
+    meta = {
+        "db_alias": cfg.local.database,
+        # Unique, so concurrent queue_upserts of one path make one document: the losers of the race get a
+        # duplicate key error, which BulkWriter retries as an update of the winner's document. Created by
+        # ensure_queue_indexes, since a Queue built before it was unique may hold duplicates.
+        "auto_create_index": False,
+        "indexes": [
+            {"fields": ["src_path"], "unique": True, "sparse": True},
+            "lease_owner",
+            ("md5sum", "lease_expires"),
+        ],
+    }
+
+
+def ensure_queue_indexes():
+    """
+    Create the Queue indexes. Older versions of build_queue inserted a file again on every run, so
+    until the src_path index is unique, documents sharing a src_path are first merged down to the
+    most complete one, and the old non-unique index is dropped.
+    """
+    collection = Queue._get_collection()
+    for attempt in range(INDEX_ATTEMPTS):
+        index = collection.index_information().get("src_path_1")
+        if index is not None and index.get("unique"):
+            break
+        removed = dedupe_queue(collection)
+        if removed:
+            logger.info(f"Removed {removed} duplicate Queue documents")
+        if index is not None:
+            collection.drop_index("src_path_1")
+        try:
+            Queue.ensure_indexes()
+            return
+        except DuplicateKeyError:  # A duplicate was inserted while we deduplicated
+            logger.warning("New duplicate Queue documents appeared; deduplicating again")
+    Queue.ensure_indexes()
+
+
+def dedupe_queue(collection):
+    """Delete all but the most complete document of each src_path; returns how many were deleted."""
+    duplicates = collection.aggregate(
+        [
+            {"$match": {"src_path": {"$type": "string"}}},
+            {"$group": {"_id": "$src_path", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    doomed = []
+    removed = 0
+    for group in duplicates:
+        docs = list(collection.find({"_id": {"$in": group["ids"]}}))
+        keep = max(docs, key=completeness)
+        doomed += [doc["_id"] for doc in docs if doc is not keep]
+        if len(doomed) >= DEDUPE_BATCH:
+            removed += collection.bulk_write([DeleteMany({"_id": {"$in": doomed}})]).deleted_count
+            doomed = []
+    if doomed:
+        removed += collection.bulk_write([DeleteMany({"_id": {"$in": doomed}})]).deleted_count
+    return removed
+
+
+def completeness(doc):
+    """Sort key preferring the Queue document that knows most about its file, then the newest."""
+    return sum(value not in (None, False, "", [], {}) for value in doc.values()), doc["_id"]
 
 
 class Candidates(me.Document):
@@ -0,0 +1,527 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Iterable, Iterator, NamedTuple
+
+from loguru import logger
+
+from large_file_hash import LargeFileHasher, is_large_file
+from photo_file_metadata import ImageMetadata, photo_file_metadata
+from locality import LocalityScheduler, locality_key
+from prefetch import prefetch_stages
+from tree_walk import walk
+
+WORKERS = 3
+CHUNK_SIZE = 50
+RESULT_QUEUE_DEPTH = 1000
+SINK_IDLE_SECONDS = 5.0  # Flush sinks when no result has arrived for this long
+JSONL_BUFFER_BYTES = 1 << 20
+JSONL_FLUSH_SECONDS = 5.0
+EXECUTORS = ("serial", "threads", "processes", "prefetch")
+LOCALITY_WINDOW = 10000  # Tasks read from the source and ordered by disk position at a time
+STAT_WORKERS = 16  # Concurrent stats when ordering tasks that don't carry their device and inode
+
+
+class Task(NamedTuple):
+    id: Any
+    path: str
+    size: int
+    dev: int = None  # Device and inode, when the source knows them, for ordering by disk position
+    inode: int = None
+
+
+def task_locality_key(task):
+    """locality.locality_key of task, without a stat when the task carries its device and inode."""
+    if task.dev is None:
+        return locality_key(task.path)
+    return task.dev, os.path.dirname(task.path), task.inode
+
+
+def keyed_window(tasks, size=LOCALITY_WINDOW):
+    """
+    The next size tasks from the iterator tasks as [(task_locality_key, task)]; the keys that need a
+    stat are looked up concurrently.
+    """
+    window = list(itertools.islice(tasks, size))
+    if all(task.dev is not None for task in window):
+        return [(task_locality_key(task), task) for task in window]
+    with ThreadPoolExecutor(max_workers=STAT_WORKERS) as pool:
+        return list(zip(pool.map(task_locality_key, window), window))
+
+
+def locality_windows(tasks, size=LOCALITY_WINDOW):
+    """tasks in locality order a window of size at a time, so only one window is held in memory."""
+    tasks = iter(tasks)
+    while True:
+        window = keyed_window(tasks, size)
+        if not window:
+            return
+        window.sort(key=lambda keyed: keyed[0])
+        yield from (task for _, task in window)
+
+
+# Sources: iterables of Tasks. They are consumed lazily, so a source is only read as fast as the
+# workers take tasks.
+
+
+class QueueSource:
+    """Queue documents matching query; by default those still without an MD5, {} for all of them."""
+
+    def __init__(self, query=None):
+        from me_models import Queue  # Mongo is only needed for the Mongo source and sink
+
+        query = {"md5sum": None} if query is None else query
+        self.queryset = Queue.objects(**query).only("id", "src_path", "size")
+
+    def __iter__(self) -> Iterator[Task]:
+        for doc in self.queryset.as_pymongo():
+            yield Task(doc["_id"], doc["src_path"], doc.get("size") or 0)
+
+
+class LeasedQueueSource:
+    """
+    Queue documents claimed through a queue_lease.QueueLease, so other workers sharing the Queue get
+    different ones. Each claimed batch is read in locality order.
+    """
+
+    def __init__(self, lease):
+        self.lease = lease
+
+    def __iter__(self) -> Iterator[Task]:
+        for batch in self.lease.batches():
+            yield from locality_windows(Task(*claimed) for claimed in batch)
+
+
+class DirectorySource:
+    """Every file under root, skipping paths in skip (a set, or a JsonlCheckpoint to resume a run)."""
+
+    def __init__(self, root, extensions=None, skip=frozenset()):
+        self.root = root
+        self.extensions = extensions
+        self.skip = skip
+
+    def __iter__(self) -> Iterator[Task]:
+        for record in walk([self.root], extensions=self.extensions):
+            if record.path not in self.skip:
+                yield Task(record.path, record.path, record.size, record.dev, record.inode)
+
+
+class JsonlSource:
+    """One JSON object per line with at least a path, e.g. an earlier JSONL sink."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __iter__(self) -> Iterator[Task]:
+        with self.path.open() as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    logger.warning(f"Skipping bad line {line!r}: {e}")
+                    continue
+                yield Task(record.get("id", record["path"]), record["path"], record.get("size", 0))
+
+
+# Sinks: write(task, metadata) is called from a single writer thread, flush() when results stop
+# arriving for a while and close() when the run ends.
+
+
+class Sink:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, task: Task, metadata: ImageMetadata):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MongoSink(Sink):
+    """
+    Bulk updates of the Queue documents the tasks came from. Large files and videos, which have no
+    image_md5, are also matched against Gphoto by MD5. With a lease, each update also gives up the
+    lease on its document.
+    """
+
+    def __init__(self, hashes=True, lease=None):
+        from bulk_writer import BulkWriter, queue_metadata_update
+        from me_models import Gphoto, Queue
+
+        self.hashes = hashes
+        self.lease = lease
+        self.update = queue_metadata_update
+        self.gphoto = Gphoto
+        self.writer = BulkWriter(Queue._get_collection())
+
+    def write(self, task, metadata):
+        if not self.hashes and not metadata.width:  # Nothing to set from a header we couldn't read
+            return
+        fields = self.lease.release_fields() if self.lease else {}
+        if self.hashes and metadata.md5sum and is_large_file(task.path, task.size):
+            match = self.gphoto.objects(md5Checksum=metadata.md5sum).only("gid", "originalFilename").first()
+            if match:
+                fields.update(gid=match.gid, in_gphotos=True, original_filename=match.originalFilename)
+                logger.info(f"In Gphotos: {task.path}")
+        self.writer.add(self.update(task.id, metadata, hashes=self.hashes, **fields))
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.__exit__(None, None, None)
+
+
+class JsonlSink(Sink):
+    """
+    One JSON line of ImageMetadata per file. The file stays open with a buffer of buffer_bytes, and is
+    flushed and fsynced whenever the buffer fills or flush_seconds have passed since the last sync, so
+    a crash loses at most that much output. With a jsonl_checkpoint.JsonlCheckpoint, each sync also
+    commits the paths written and the synced length of the file to it.
+    """
+
+    def __init__(self, path, buffer_bytes=JSONL_BUFFER_BYTES, flush_seconds=JSONL_FLUSH_SECONDS, checkpoint=None):
+        self.fp = Path(path).open(mode="a", buffering=buffer_bytes)
+        self.buffer_bytes = buffer_bytes
+        self.flush_seconds = flush_seconds
+        self.checkpoint = checkpoint
+        self.unsynced = 0
+        self.unsynced_paths = []
+        self.last_sync = time.monotonic()
+
+    def write(self, task, metadata):
+        line = f"{json.dumps(asdict(metadata))}\n"
+        self.fp.write(line)
+        self.unsynced += len(line)
+        self.unsynced_paths.append(metadata.path)
+        if self.unsynced >= self.buffer_bytes or time.monotonic() - self.last_sync >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_sync = time.monotonic()
+        if not self.unsynced:
+            return
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        if self.checkpoint is not None:
+            self.checkpoint.commit(os.fstat(self.fp.fileno()).st_size, self.unsynced_paths)
+        self.unsynced = 0
+        self.unsynced_paths = []
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+class FirestoreSink(Sink):
+    """Documents in a Firestore collection, committed in batches."""
+
+    BATCH_SIZE = 500  # Firestore's limit on writes per batch
+
+    def __init__(self, collection="local_photos"):
+        from firebase import get_firestore_db
+
+        self.db = get_firestore_db()
+        self.collection = self.db.collection(collection)
+        self.batch = self.db.batch()
+        self.pending = 0
+
+    def write(self, task, metadata):
+        self.batch.set(self.collection.document(), asdict(metadata))
+        self.pending += 1
+        if self.pending >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.batch.commit()
+            self.batch = self.db.batch()
+            self.pending = 0
+
+
+# Executors
+
+
+class SerialExecutor(Executor):
+    """Runs each task in the calling thread when it is submitted."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def make_executor(kind, workers) -> Executor:
+    if kind == "serial":
+        return SerialExecutor()
+    if kind == "threads":
+        return ThreadPoolExecutor(max_workers=workers)
+    if kind == "processes":
+        return ProcessPoolExecutor(max_workers=workers)
+    raise ValueError(f"Unknown executor {kind}; expected one of {EXECUTORS}")
+
+
+def process_chunk(tasks, image_md5=True, metadata_only=False):
+    """
+    Worker: (task, ImageMetadata) for each task that could be read. A file that can't be read or
+    decoded (corrupt, truncated, a decompression bomb) is logged and skipped, so it costs its own
+    record and not the rest of the chunk.
+    """
+    results = []
+    for task in tasks:
+        logger.info(f"Getting metadata from: {task.path}")
+        try:
+            results.append((task, photo_file_metadata(Path(task.path), image_md5, metadata_only)))
+        except OSError as e:
+            logger.warning(f"Can't read {task.path}: {e}")
+        except Exception as e:  # Whatever PIL or the header parser raise for a bad file
+            logger.warning(f"Can't decode {task.path}: {e!r}")
+    return results
+
+
+def run(
+    source: Iterable[Task],
+    sink: Sink,
+    executor="processes",
+    workers=WORKERS,
+    chunk_size=CHUNK_SIZE,
+    image_md5=True,
+    metadata_only=False,
+    locality=False,
+):
+    """
+    Extract metadata for every task from source and write it to sink.
+
+    Tasks are handed to the executor in chunks with at most 2 * workers chunks in flight, and results
+    pass to a writer thread through a queue of RESULT_QUEUE_DEPTH. A slow sink therefore stalls the
+    workers and a slow worker pool stalls the source, instead of either piling up in memory. Large
+    files and videos go to the streaming hasher rather than the workers.
+
+    The prefetch executor instead overlaps reading and decoding: see prefetch.prefetch_stages, which
+    runs up to workers decode processes. Header-only reads gain nothing from prefetching whole files,
+    so metadata_only runs use threads instead.
+
+    With locality, the source is read and ordered by disk position LOCALITY_WINDOW tasks at a time:
+    workers take their chunks from a locality.LocalityScheduler over the current window, and the
+    prefetch readers read each window in that order.
+    """
+    if executor == "prefetch" and metadata_only:
+        executor = "threads"
+    start = time.monotonic()
+    results = queue.Queue(maxsize=RESULT_QUEUE_DEPTH)
+    counts = {"written": 0}
+    writer = threading.Thread(target=_write, args=(results, sink, counts), daemon=True)
+    writer.start()
+    try:
+        if executor == "prefetch":
+            tasks = locality_windows(source) if locality else source
+            prefetch_stages(iter(tasks), results, decoders=workers, image_md5=image_md5)
+        elif locality:
+            _locality_stages(source, results, executor, workers, chunk_size, image_md5, metadata_only)
+        else:
+            _chunk_stages(iter(source), results, executor, workers, chunk_size, image_md5, metadata_only)
+    finally:
+        while writer.is_alive():
+            try:
+                results.put(None, timeout=SINK_IDLE_SECONDS)
+                break
+            except queue.Full:
+                continue
+        writer.join()
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"Pipeline ({executor}, {workers} workers) wrote {counts['written']} records in {elapsed:.1f}s "
+        f"({counts['written'] / elapsed if elapsed else 0:.1f}/s)"
+    )
+    if counts.get("dropped"):
+        logger.error(f"{counts['dropped']} results were dropped after the sink failed")
+
+
+def _chunk_stages(tasks, results, executor, workers, chunk_size, image_md5, metadata_only):
+    max_in_flight = 2 * workers
+    with make_executor(executor, workers) as pool, LargeFileHasher() as hasher:
+        in_flight = {}
+        pending = []
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                elif is_large_file(task.path, task.size) and not metadata_only:
+                    in_flight[hasher.submit(task.path)] = task
+                    continue
+                else:
+                    pending.append(task)
+                if pending and (len(pending) >= chunk_size or exhausted):
+                    in_flight[pool.submit(process_chunk, pending, image_md5, metadata_only)] = None
+                    pending = []
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                try:
+                    if task is None:
+                        for result in future.result():
+                            results.put(result)
+                    else:
+                        results.put((task, ImageMetadata(path=task.path, size=task.size, md5sum=future.result())))
+                except OSError as e:
+                    logger.warning(f"Task failed: {e}")
+
+
+def _locality_stages(source, results, executor, workers, chunk_size, image_md5, metadata_only):
+    """
+    _chunk_stages with each worker slot taking its next chunk from a LocalityScheduler. The source is
+    scheduled a window at a time, and the next window is read and keyed while the current one is
+    processed, so workers start as soon as the first window is ready and memory stays bounded.
+    """
+    tasks = iter(source)
+    scheduler = LocalityScheduler([], workers)
+    steals = 0
+    with make_executor(executor, workers) as pool, LargeFileHasher() as hasher, \
+            ThreadPoolExecutor(max_workers=1) as loader:
+        window = loader.submit(keyed_window, tasks)
+        in_flight = {}
+        idle = list(range(workers))
+        while True:
+            for worker in list(idle):
+                chunk = scheduler.take(worker, chunk_size)
+                while not chunk and window is not None:
+                    keyed = window.result()
+                    window = loader.submit(keyed_window, tasks) if keyed else None
+                    steals += scheduler.steals
+                    small = []
+                    for key, task in keyed:
+                        if is_large_file(task.path, task.size) and not metadata_only:
+                            in_flight[hasher.submit(task.path)] = task
+                        else:
+                            small.append((key, task))
+                    scheduler = LocalityScheduler(small, workers, key=lambda keyed_task: keyed_task[0])
+                    chunk = scheduler.take(worker, chunk_size)
+                if chunk:
+                    in_flight[pool.submit(process_chunk, [task for _, task in chunk], image_md5, metadata_only)] = worker
+                    idle.remove(worker)
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                owner = in_flight.pop(future)
+                try:
+                    if isinstance(owner, Task):
+                        results.put((owner, ImageMetadata(path=owner.path, size=owner.size, md5sum=future.result())))
+                    else:
+                        for result in future.result():
+                            results.put(result)
+                except OSError as e:
+                    logger.warning(f"Task failed: {e}")
+                if not isinstance(owner, Task):
+                    idle.append(owner)
+    logger.info(f"Locality scheduling: {steals + scheduler.steals} steals")
+
+
+def _write(results, sink, counts):
+    """
+    Writer thread: blocks until a result arrives, flushing the sink whenever the pipeline goes quiet.
+    Failed writes and flushes are logged and the writer carries on. If the sink fails altogether, the
+    writer keeps taking results off the queue, counting them as dropped, so the workers never block
+    on a queue nobody empties.
+    """
+    finished = False
+    try:
+        with sink:
+            while True:
+                try:
+                    result = results.get(timeout=SINK_IDLE_SECONDS)
+                except queue.Empty:
+                    try:
+                        sink.flush()
+                    except Exception as e:  # Pending records stay buffered for the next flush
+                        logger.warning(f"Sink flush failed: {e}")
+                    continue
+                if result is None:
+                    finished = True
+                    return
+                try:
+                    sink.write(*result)
+                    counts["written"] += 1
+                except Exception as e:  # One bad record shouldn't stop the writer and stall the pipeline
+                    logger.warning(f"Sink write failed for {result[0].path}: {e}")
+    except Exception as e:
+        logger.error(f"Sink failed: {e}")
+    finally:
+        if not finished:
+            while results.get() is not None:
+                counts["dropped"] = counts.get("dropped", 0) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract photo metadata from a source into a sink.")
+    parser.add_argument("--source", default="queue", help="queue | dir:PATH | jsonl:PATH")
+    parser.add_argument("--sink", default="mongo", help="mongo | jsonl:PATH | firestore[:COLLECTION]")
+    parser.add_argument("--executor", default="processes", choices=EXECUTORS)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--no-image-md5", dest="image_md5", action="store_false")
+    parser.add_argument("--metadata-only", action="store_true")
+    parser.add_argument("--locality", action="store_true", help="Order and spread work by position on disk")
+    args = parser.parse_args()
+    if args.source == "queue" or args.sink == "mongo":
+        from me_models import DbConnect
+
+        DbConnect()
+    run(
+        parse_source(args.source),
+        parse_sink(args.sink, hashes=not args.metadata_only),
+        executor=args.executor,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        image_md5=args.image_md5,
+        metadata_only=args.metadata_only,
+        locality=args.locality,
+    )
+
+
+def parse_source(spec):
+    kind, _, arg = spec.partition(":")
+    if kind == "queue":
+        return QueueSource()
+    if kind == "dir":
+        return DirectorySource(arg)
+    if kind == "jsonl":
+        return JsonlSource(arg)
+    raise ValueError(f"Unknown source {spec}")
+
+
+def parse_sink(spec, hashes=True):
+    kind, _, arg = spec.partition(":")
+    if kind == "mongo":
+        return MongoSink(hashes=hashes)
+    if kind == "jsonl":
+        return JsonlSink(arg)
+    if kind == "firestore":
+        return FirestoreSink(arg or "local_photos")
+    raise ValueError(f"Unknown sink {spec}")
+
+
+if __name__ == "__main__":
+    logger.add("update_metadata.log", rotation="100 MB")
+    main()
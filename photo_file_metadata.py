@@ -1,19 +1,26 @@
 from hashlib import md5
 import io
+import mmap
+import os
+from contextlib import contextmanager
 from dataclasses import dataclass, asdict
 from pathlib import Path
 import json
 
 import PIL
 from PIL import ImageFile
-import exif
 from PIL import Image
 from loguru import logger
 
-from utils import file_md5sum
+from exif_header import ExifHeader, parse_exif_header, read_exif_header
+from hash_cache import NO_HASHES, CachedHashes, hash_cache, put_if_unchanged
+from large_file_hash import LARGE_FILE_BYTES, stream_md5
 
 # TODO:  Add HEIC tag support. exif-py package maybe??
-# TODO:  Filter file types for exif extraction - png for example doesn't have useful metadata
+
+HASH_CHUNK = 1 << 20
+STRIP_BYTES = 4 << 20
+NOT_IMAGES = ['.mov', '.mp4', '.avi', '.json', '.rw2']  # TODO: Look at results and refine list
 
 
 @dataclass
@@ -33,63 +40,167 @@ class ImageMetadata:
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
-def photo_file_metadata(filepath: Path) -> ImageMetadata:  # TODO:  Make accept path_string, file_pointer, or Path
+def photo_file_metadata(filepath: Path, image_md5=True, metadata_only=False) -> ImageMetadata:  # TODO:  Make accept path_string, file_pointer, or Path
     """
-    Extract metadata from file path.
+    Extract metadata from file path. The file is read once, through a memory map, and the MD5, image
+    decoder and EXIF parser all work from that mapping rather than from private copies of the bytes.
     :param filepath:
+    :param image_md5: Decode the pixels to compute image_md5
+    :param metadata_only: Only read the EXIF/frame header; no hashes, no pixel decode
     :return ImageMetadata:  TODO: Finish me
     """
 
+    if metadata_only:
+        return header_metadata(filepath)
+    st = filepath.stat()
+    result = ImageMetadata(path=str(filepath), size=st.st_size)
+    if result.size > LARGE_FILE_BYTES:
+        result.md5sum = stream_md5(str(filepath))
+        return result
+    with mapped_file(filepath) as photo_b:
+        buffer_metadata(filepath, photo_b, result, hash_cache().get(st) or NO_HASHES, image_md5)
+    put_if_unchanged(st, filepath, md5sum=result.md5sum, image_md5=result.image_md5 or None)
+    return result
+
+
+def header_metadata(filepath: Path) -> ImageMetadata:
+    """
+    Metadata from the first few KB of the file only, so the cost is a seek rather than a read of the
+    whole file. Formats without an EXIF/frame header we parse fall back to PIL, which also only reads
+    the header until pixels are requested.
+    """
     result = ImageMetadata(path=str(filepath), size=filepath.stat().st_size)
-    if result.size > 100e6:
-        result.md5sum = file_md5sum(str(filepath))
+    if filepath.suffix.lower() in NOT_IMAGES:
         return result
-    photo_b = filepath.read_bytes()
-    result.md5sum = md5(photo_b).hexdigest()
-    if filepath.suffix.lower() in ['.mov', '.mp4', '.avi', '.json', '.rw2']:  #  TODO: Look at results and refine list
+    try:
+        apply_exif_header(result, read_exif_header(filepath))
+        if not result.width:
+            with PIL.Image.open(filepath) as im:
+                result.width = im.width
+                result.height = im.height
+    except (OSError, PIL.UnidentifiedImageError, ValueError, TypeError) as e:
+        logger.warning(f"{filepath} header could not be read: {e}")
+    return result
+
+
+def buffer_metadata(
+    filepath, photo_b, result: ImageMetadata, cached: CachedHashes = NO_HASHES, image_md5=True
+) -> ImageMetadata:
+    """
+    Fill result from the file contents in photo_b (bytes, mmap or any other buffer). Hashes already
+    in cached aren't recomputed, so a cached file is only read as far as its header.
+    """
+    result.md5sum = cached.md5sum or buffer_md5(photo_b)
+    if Path(filepath).suffix.lower() in NOT_IMAGES:
+        return result
+    extract_exif_data(filepath, photo_b, result)
+    if result.width and not image_md5:
         return result
     try:
-        im = PIL.Image.open(io.BytesIO(photo_b))
+        with buffer_file(photo_b) as fp, PIL.Image.open(fp) as im:
+            result.width = im.width
+            result.height = im.height
+            if image_md5:
+                result.image_md5 = cached.image_md5 or image_md5_digest(im)
     except FileNotFoundError:
         logger.critical(f"{filepath} not found")
-        return result
     except (PIL.UnidentifiedImageError, ValueError, TypeError) as e:
         logger.warning(f"{filepath} is a type PIL does not recognize: {e}")
-        return result
-    result.width = im.width
-    result.height = im.height
-    result.image_md5 = md5(im.tobytes()).hexdigest()
-    extract_exif_data(filepath, photo_b, result)
     return result
 
 
+@contextmanager
+def mapped_file(filepath):
+    """
+    Map a file read-only. Pages are shared with the OS file cache instead of being copied into the
+    process, so they don't add to the worker's private memory.
+    """
+    with open(filepath, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:  # Empty files can't be mapped
+            yield b''
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def buffer_md5(buf) -> str:
+    digest = md5()
+    with memoryview(buf) as view:
+        for offset in range(0, len(view), HASH_CHUNK):
+            digest.update(view[offset:offset + HASH_CHUNK])
+    return digest.hexdigest()
+
+
+def image_md5_digest(im) -> str:
+    """
+    md5(im.tobytes()).hexdigest() without materializing im.tobytes(): the decoded image is hashed in
+    full-width row strips of about STRIP_BYTES. The raw encoder packs every row independently, so the
+    strips concatenate to exactly the bytes of tobytes() and the digest matches existing image_md5s.
+    """
+    digest = md5()
+    rows = max(1, STRIP_BYTES // max(1, im.width * len(im.getbands())))
+    for top in range(0, im.height, rows):
+        digest.update(im.crop((0, top, im.width, min(top + rows, im.height))).tobytes())
+    return digest.hexdigest()
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Seekable read-only file over a buffer (bytes, mmap, shared memory) that copies only what is read,
+    unlike BytesIO, which copies the whole buffer up front. Closing it releases its view of the buffer,
+    so the owner can then close an mmap or shared memory segment.
+    """
+
+    def __init__(self, buf):
+        self.view = memoryview(buf).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+def buffer_file(buf):
+    """Seekable file object over buf for PIL."""
+    return BufferReader(buf)
+
+
 def extract_exif_data(filepath, photo_b, result):
     try:
-        exif_data = exif.Image(photo_b)
+        apply_exif_header(result, parse_exif_header(photo_b))
     except Exception as e:  # TODO: Refine this broad except
         logger.warning(f"{filepath} extracting exif data had unexpected error: {e}")
-        return result
-    if exif_data.has_exif:
-        try:
-            result.camera_make = exif_data.get('make', None)
-            if result.camera_make and (result.camera_make[-3] == '\x00'):
-                result.camera_make = result.camera_make[0:30].rstrip('\x00')
-        except Exception as e:
-            logger.warning(f"{filepath} extracting camera make had unexpected error: {e}")
-        try:
-            result.camera_model = exif_data.get('model', None)
-            if result.camera_model and (result.camera_model[-3] == '\x00'):
-                result.camera_model = result.camera_model[0:30].rstrip('\x00')
-        except Exception as e:
-            logger.warning(f"{filepath} extracting camera model had unexpected error: {e}")
-        try:
-            result.creation_time = exif_data.get('datetime', None)
-        except Exception as e:
-            logger.warning(f"{filepath} extracting datatime had unexpected error: {e}")
-        try:
-            result.datetime_original = exif_data.get('datetime_original', None)
-        except Exception as e:
-            logger.warning(f"{filepath} extracting datetime_oringinal had unexpected error: {e}")
+    return result
+
+
+def apply_exif_header(result: ImageMetadata, header: ExifHeader):
+    result.camera_make = header.make
+    result.camera_model = header.model
+    result.creation_time = header.datetime
+    result.datetime_original = header.datetime_original
+    result.width = header.width
+    result.height = header.height
     return result
 
 
@@ -0,0 +1,171 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from loguru import logger
+
+from hash_cache import NO_HASHES, hash_cache, put_if_unchanged
+from large_file_hash import LargeFileHasher, is_large_file
+from photo_file_metadata import ImageMetadata, buffer_metadata
+
+MAX_READERS = 16
+MAX_DECODERS = os.cpu_count() or 1
+PREFETCH_BYTES = 256 << 20  # Cap on file bytes held in shared memory, read but not yet decoded
+ADAPT_SECONDS = 2.0
+ADAPT_TOLERANCE = 0.05  # Throughput changes smaller than this don't count as better or worse
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit tuned by hill climbing on throughput: every interval the limit takes a step, and
+    the step reverses direction whenever throughput got worse than in the previous interval.
+    """
+
+    def __init__(self, name, start, maximum, interval=ADAPT_SECONDS):
+        self.name = name
+        self.limit = max(1, min(start, maximum))
+        self.maximum = maximum
+        self.interval = interval
+        self.step = 1
+        self.done = 0
+        self.last_rate = 0.0
+        self.last = time.monotonic()
+
+    def record(self, amount=1):
+        self.done += amount
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        rate = self.done / (now - self.last)
+        if rate < self.last_rate * (1 - ADAPT_TOLERANCE):
+            self.step = -self.step
+        self.limit = max(1, min(self.limit + self.step, self.maximum))
+        logger.debug(f"{self.name}: {rate:.1f}/s, limit now {self.limit}")
+        self.last_rate = rate
+        self.done = 0
+        self.last = now
+
+
+def read_segment(path):
+    """Reader thread: the whole file read into a new shared memory segment; returns (segment, stat)."""
+    with open(path, 'rb', buffering=0) as fp:
+        st = os.fstat(fp.fileno())
+        segment = SharedMemory(create=True, size=max(1, st.st_size))  # Segments can't be empty
+        try:
+            with segment.buf[:st.st_size] as view:
+                n = 0
+                while n < st.st_size:
+                    read = fp.readinto(view[n:])
+                    if not read:
+                        raise OSError(f"{path} shrank while being read")
+                    n += read
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+    return segment, st
+
+
+def decode_segment(task, name, st, image_md5=True):
+    """Decode process: metadata for a file already in the shared memory segment called name."""
+    segment = SharedMemory(name=name)  # Tracked by the parent's resource tracker, which pool workers share
+    try:
+        result = ImageMetadata(path=str(task.path), size=st.st_size)
+        with segment.buf[:st.st_size] as view:
+            buffer_metadata(task.path, view, result, hash_cache().get(st) or NO_HASHES, image_md5)
+    finally:
+        segment.close()
+    put_if_unchanged(st, task.path, md5sum=result.md5sum, image_md5=result.image_md5 or None)
+    return task, result
+
+
+def prefetch_stages(tasks, results, readers=MAX_READERS, decoders=MAX_DECODERS, image_md5=True):
+    """
+    Metadata for each task put on results as (task, ImageMetadata), in two stages: reader threads
+    read whole files into shared memory and decode processes hash and decode them from there, so
+    only segment names, not file contents, are pickled. Each stage's concurrency adapts separately
+    between 1 and readers or decoders, and at most PREFETCH_BYTES are held between the stages. Large
+    files and videos go to the streaming hasher instead.
+    """
+    read_limit = AdaptiveLimit("Prefetch readers", 2, readers)
+    decode_limit = AdaptiveLimit("Decoders", decoders, decoders)
+    reading = {}
+    ready = deque()
+    decoding = {}
+    hashing = {}
+    buffered = 0
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=readers) as read_pool, \
+            ProcessPoolExecutor(max_workers=decoders) as decode_pool, LargeFileHasher() as hasher:
+        # Fork the decode processes before any reader runs: a process forked while a reader is creating
+        # a segment inherits the resource tracker's lock held, and hangs attaching to its first segment.
+        # Start the tracker first, so they share it rather than each starting their own. There is no
+        # tracker on Windows, which spawns rather than forks anyway.
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+        decode_pool.submit(os.getpid).result()
+        try:
+            while True:
+                while not exhausted and len(reading) < read_limit.limit and (
+                    buffered < PREFETCH_BYTES or not (reading or ready or decoding)
+                ):
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                    elif is_large_file(task.path, task.size):
+                        hashing[hasher.submit(task.path)] = task
+                    else:
+                        reading[read_pool.submit(read_segment, task.path)] = task
+                        buffered += task.size
+                while ready and len(decoding) < decode_limit.limit:
+                    task, segment, st = ready.popleft()
+                    decoding[decode_pool.submit(decode_segment, task, segment.name, st, image_md5)] = task, segment
+                if not (reading or decoding or hashing):
+                    break
+                done, _ = wait([*reading, *decoding, *hashing], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in reading:
+                        task = reading.pop(future)
+                        try:
+                            segment, st = future.result()
+                        except OSError as e:
+                            buffered -= task.size
+                            logger.warning(f"Can't read {task.path}: {e}")
+                            continue
+                        ready.append((task, segment, st))
+                        read_limit.record(st.st_size)
+                    elif future in decoding:
+                        task, segment = decoding.pop(future)
+                        buffered -= task.size
+                        segment.close()
+                        segment.unlink()
+                        try:
+                            results.put(future.result())
+                        except OSError as e:
+                            logger.warning(f"Can't read {task.path}: {e}")
+                        except Exception as e:  # A bad file costs its own record, not the run
+                            logger.warning(f"Can't decode {task.path}: {e!r}")
+                        decode_limit.record()
+                    else:
+                        task = hashing.pop(future)
+                        try:
+                            results.put((task, ImageMetadata(path=task.path, size=task.size, md5sum=future.result())))
+                        except OSError as e:
+                            logger.warning(f"Can't hash {task.path}: {e}")
+        finally:
+            # Don't leave segments behind in /dev/shm if we stop early
+            for future in reading:
+                future.cancel()
+            for future in list(reading):
+                if not future.cancelled() and future.exception() is None:
+                    ready.append((reading[future], *future.result()))
+            wait(decoding)
+            for _, segment, _ in ready:
+                segment.close()
+                segment.unlink()
+            for _, segment in decoding.values():
+                segment.close()
+                segment.unlink()
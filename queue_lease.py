@@ -0,0 +1,106 @@
+import datetime
+import os
+import socket
+import threading
+import uuid
+
+from loguru import logger
+from pymongo import ReturnDocument
+
+from me_models import Queue
+
+LEASE_SECONDS = 600
+HEARTBEAT_SECONDS = 60
+CLAIM_BATCH = 200
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class QueueLease:
+    """
+    Claims on Queue documents so several workers, on any number of machines, can share one backlog.
+
+    A document is claimed by setting lease_owner and lease_expires in a single find_one_and_update, so
+    two workers can never claim the same one. While the lease is held, a heartbeat thread extends
+    every lease the worker owns every HEARTBEAT_SECONDS. Once a worker stops heartbeating, for example
+    because it crashed, its leases run out and the documents become claimable again. Leases are given
+    up by clearing the fields, either in the update that writes the result (release_fields) or on exit.
+    in_process is left alone: App.check_gphotos_membership uses it to mark photos already logged.
+
+    batches() claims matching documents CLAIM_BATCH at a time until none are left.
+    """
+
+    def __init__(self, query=None, owner=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS):
+        self.collection = Queue._get_collection()
+        self.query = {"md5sum": None} if query is None else query
+        self.owner = owner or worker_id()
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        self.release()
+
+    def batches(self, n=CLAIM_BATCH):
+        while True:
+            batch = self.claim(n)
+            if not batch:
+                return
+            yield batch
+
+    def claim(self, n):
+        """Claim up to n unleased (or expired) matching documents; returns [(id, src_path, size)]."""
+        claimed = []
+        for _ in range(n):
+            now = datetime.datetime.now(datetime.timezone.utc)
+            doc = self.collection.find_one_and_update(
+                {**self.query, "$or": [{"lease_expires": None}, {"lease_expires": {"$lt": now}}]},
+                {"$set": {"lease_owner": self.owner, "lease_expires": now + self.lease}},
+                projection={"_id": 1, "src_path": 1, "size": 1, "lease_owner": 1},
+                return_document=ReturnDocument.BEFORE,
+            )
+            if doc is None:
+                break
+            if doc.get("lease_owner"):
+                logger.info(f"Reclaimed expired lease on {doc['src_path']} from {doc['lease_owner']}")
+            claimed.append((doc["_id"], doc["src_path"], doc.get("size") or 0))
+        logger.debug(f"{self.owner} claimed {len(claimed)} documents")
+        return claimed
+
+    def heartbeat(self):
+        """Extend every lease this worker holds."""
+        expires = datetime.datetime.now(datetime.timezone.utc) + self.lease
+        result = self.collection.update_many({"lease_owner": self.owner}, {"$set": {"lease_expires": expires}})
+        logger.debug(f"{self.owner} extended {result.modified_count} leases")
+
+    def release(self, ids=None):
+        """Give up the leases on ids, or all of this worker's leases."""
+        query = {"lease_owner": self.owner}
+        if ids is not None:
+            query["_id"] = {"$in": list(ids)}
+        result = self.collection.update_many(query, {"$set": self.release_fields()})
+        if result.modified_count:
+            logger.info(f"{self.owner} released {result.modified_count} leases")
+
+    @staticmethod
+    def release_fields():
+        """Fields to $set to give up a lease, for including in the update that stores a result."""
+        return {"lease_owner": None, "lease_expires": None}
+
+    def _heartbeat_loop(self):
+        while not self.stopped.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except Exception as e:  # A missed heartbeat is survivable; the next one may get through
+                logger.warning(f"Lease heartbeat failed: {e}")
@@ -0,0 +1,276 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Per API: requests per second, burst, and most requests in flight at once. These sit a little under the
+# published per-user quotas (Drive: 12,000 queries a minute); the schedulers back off from them on 429s.
+API_LIMITS = {
+    "drive": dict(rate=150.0, burst=50, concurrency=16),
+    "photos": dict(rate=5.0, burst=10, concurrency=4),
+    "photos_upload": dict(rate=5.0, burst=10, concurrency=4),
+}
+MAX_RETRIES = 8
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 64.0
+DECREASE_FACTOR = 0.7  # Rate and concurrency are cut to this fraction when the API pushes back
+RECOVERY_SECONDS = 60.0  # Time to climb back from no rate to the full rate while requests succeed
+METRICS_SECONDS = 60.0
+ASYNC_POLL_SECONDS = 0.05
+THROTTLED = {429}
+SERVER_ERRORS = {500, 502, 503, 504}
+RETRYABLE = ("throttled", "server_errors", "network_errors")
+RATE_LIMIT_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded")  # Google sends some quota errors as 403
+
+
+def status_of(outcome):
+    """HTTP status of a response or HTTP error from googleapiclient, requests, aiohttp or urllib, else None."""
+    for attr in ("status_code", "status", "code"):
+        status = getattr(outcome, attr, None)
+        if isinstance(status, int):
+            return status
+    resp = getattr(outcome, "resp", None)  # googleapiclient.errors.HttpError
+    return getattr(resp, "status", None)
+
+
+def retry_after(outcome):
+    """Seconds asked for by a Retry-After header on outcome, if any."""
+    headers = getattr(outcome, "headers", None) or getattr(outcome, "resp", None)  # resp: httplib2, a dict
+    value = headers.get("retry-after") if hasattr(headers, "get") else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    Rate limit, concurrency cap and retries shared by every call to one API.
+
+    Calls take tokens from a bucket refilled at rate per second (holding at most burst), then wait for
+    one of limit slots. A throttled response (429, or a 403 rate limit error) pauses every caller, for
+    an exponential backoff with jitter that grows while the API keeps throttling, or for as long as
+    Retry-After asks. It also empties the bucket, so the pause doesn't end in a burst, and cuts the rate
+    and the concurrency limit by DECREASE_FACTOR; successes raise them again, additively, up to the
+    configured ceiling. The scheduler therefore settles just under the quota instead of running into it
+    over and over. A call that gets a server error or a network error (transient, OSError by default)
+    backs off on its own, exponentially in its number of attempts. Calls that aren't idempotent, such as
+    creating media items, pass idempotent=False: a server or network error may come after the request
+    took effect, so they are only retried when throttled, which means the request was turned away.
+
+    Outcomes are read by duck typing, so the same scheduler works for googleapiclient requests, requests,
+    aiohttp and urllib: a retryable response is retried and the last one returned, a retryable error is
+    retried and the last one raised. metrics() counts what happened.
+    """
+
+    def __init__(self, name, rate, burst=None, concurrency=8, retries=MAX_RETRIES, transient=(OSError,)):
+        self.name = name
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = self.max_rate / 100
+        self.burst = burst or max(1.0, self.max_rate)
+        self.max_concurrency = self.limit = float(concurrency)
+        self.retries = retries
+        self.transient = transient
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.backoffs = 0  # Pauses in a row without a success in between
+        self.in_flight = 0
+        self.counts = Counter()
+        self.last_log = time.monotonic()
+        self.lock = threading.Lock()
+        self.slot_free = threading.Condition(self.lock)
+
+    def call(self, fn, *args, cost=1, idempotent=True, **kwargs):
+        """fn(*args, **kwargs) when the rate and concurrency limits allow it, retried as needed."""
+        attempt = 0
+        while True:
+            with self.slot(cost):
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self.retry(e, attempt, cost, idempotent)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self.retry(result, attempt, cost, idempotent)
+                    if delay is None:
+                        return result
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn, *args, cost=1, idempotent=True, **kwargs):
+        """As call, for a coroutine function fn, without blocking the event loop."""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(cost))
+            while (wait := self._resume_wait()) > 0:
+                await asyncio.sleep(wait)
+            while not self._try_enter():
+                await asyncio.sleep(ASYNC_POLL_SECONDS)
+                self.counts["wait_seconds"] += ASYNC_POLL_SECONDS
+            try:
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self.retry(e, attempt, cost, idempotent)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self.retry(result, attempt, cost, idempotent)
+                    if delay is None:
+                        return result
+            finally:
+                self._exit()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @contextmanager
+    def slot(self, cost=1):
+        """Wait for cost tokens and a free slot, and hold the slot for the duration."""
+        time.sleep(self._reserve(cost))
+        while (wait := self._resume_wait()) > 0:  # A backoff may have started while we waited
+            time.sleep(wait)
+        with self.slot_free:
+            start = time.monotonic()
+            while self.in_flight >= int(self.limit):
+                self.slot_free.wait()
+            self.counts["wait_seconds"] += time.monotonic() - start
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def retryable(self, outcome):
+        """Whether outcome, a response or an exception, is worth retrying."""
+        return self._classify(outcome) in RETRYABLE
+
+    def retry(self, outcome, attempt=0, cost=1, idempotent=True):
+        """
+        Account for outcome of a call on its attempt'th retry and adapt the limits to it. Returns the
+        seconds to back off before trying again, or None if the call shouldn't be retried; a call that
+        isn't idempotent is only retried when throttled.
+        """
+        kind = self._classify(outcome)
+        with self.lock:
+            self.counts["requests"] += 1
+            now = time.monotonic()
+            if kind == "ok":
+                self.counts["succeeded"] += 1
+                self.rate = min(self.max_rate, self.rate + cost * self.max_rate / (self.rate * RECOVERY_SECONDS))
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                if now >= self.resume_at:  # Not a reply to a request sent before the pause
+                    self.backoffs = 0
+            elif kind != "error":
+                self.counts[kind] += 1
+            if kind == "throttled":
+                if now >= self.resume_at:  # The first reply that says so; the rest were sent before the pause
+                    self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self.tokens = min(self.tokens, 0.0)
+                    pause = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** self.backoffs)
+                    self.resume_at = now + pause * random.uniform(0.5, 1.0)
+                    self.backoffs += 1
+                self.resume_at = max(self.resume_at, now + (retry_after(outcome) or 0.0))
+                delay = self.resume_at - now
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+            retrying = kind in (RETRYABLE if idempotent else ("throttled",)) and attempt < self.retries
+            if retrying:
+                self.counts["retries"] += 1
+                self.counts["backoff_seconds"] += delay
+                logger.debug(f"{self.name}: {kind} ({status_of(outcome) or outcome}), retry {attempt + 1} in {delay:.1f}s")
+            elif kind != "ok":
+                self.counts["failed"] += 1
+            log = now - self.last_log >= METRICS_SECONDS
+            if log:
+                self.last_log = now
+        if log:
+            self.log_metrics()
+        return delay if retrying else None
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counts, rate=self.rate, limit=int(self.limit), in_flight=self.in_flight)
+
+    def log_metrics(self):
+        m = self.metrics()
+        logger.info(
+            f"{self.name}: {m.get('requests', 0)} requests, {m.get('succeeded', 0)} ok, "
+            f"{m.get('throttled', 0)} throttled, {m.get('server_errors', 0)} server errors, "
+            f"{m.get('network_errors', 0)} network errors, {m.get('retries', 0)} retries, {m.get('failed', 0)} failed; "
+            f"waited {m.get('wait_seconds', 0):.1f}s, backed off {m.get('backoff_seconds', 0):.1f}s; rate {m['rate']:.1f}/s, limit {m['limit']}, in flight {m['in_flight']}"
+        )
+
+    def _classify(self, outcome):
+        status = status_of(outcome)
+        if status is None:
+            if isinstance(outcome, BaseException):
+                return "network_errors" if isinstance(outcome, self.transient) else "error"
+            return "ok"
+        if status in THROTTLED:
+            return "throttled"
+        if status in SERVER_ERRORS:
+            return "server_errors"
+        if status == 403:
+            content = getattr(outcome, "content", b"") or b""
+            content = content.encode() if isinstance(content, str) else content
+            if any(reason in content for reason in RATE_LIMIT_REASONS):
+                return "throttled"
+        if status >= 400 or isinstance(outcome, BaseException):
+            return "error"
+        return "ok"
+
+    def _reserve(self, cost):
+        """Take cost tokens, going into debt if need be; returns how long to wait until they are covered."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            wait = max(0.0, -self.tokens / self.rate, self.resume_at - now)
+            self.counts["wait_seconds"] += wait
+            return wait
+
+    def _resume_wait(self):
+        with self.lock:
+            wait = self.resume_at - time.monotonic()
+            if wait > 0:
+                self.counts["wait_seconds"] += wait
+            return wait
+
+    def _try_enter(self):
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def _exit(self):
+        with self.slot_free:
+            self.in_flight -= 1
+            self.slot_free.notify()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler(api):
+    """The process-wide RequestScheduler for api, one of API_LIMITS, shared by every caller of that API."""
+    with _schedulers_lock:
+        if api not in _schedulers:
+            _schedulers[api] = RequestScheduler(api, **API_LIMITS[api])
+        return _schedulers[api]
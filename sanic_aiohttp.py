@@ -5,23 +5,31 @@ import sys
 
 
 from oauth2creds import get_credentials
+from rate_limit import scheduler
 
 credentials=get_credentials()
 
 app = Sanic(__name__)
+drive_api = scheduler("drive")
 
 
 async def fetch(session, url):
     """
-    Use session object to perform 'get' request on url
+    Use session object to perform 'get' request on url, rate limited and retried by drive_api
     """
     creds = get_credentials()
 
     headers = {
         "Authorization": f"Bearer {creds.token}"
     }
-    async with session.get(url, headers=headers) as result:
-        return await result.json()
+
+    async def get():
+        async with session.get(url, headers=headers) as result:
+            await result.read()  # Keeps the body once the connection is released
+            return result
+
+    result = await drive_api.call_async(get)
+    return await result.json()
 
 
 @app.route('/')
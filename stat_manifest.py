@@ -0,0 +1,128 @@
+import os
+import sqlite3
+from typing import Iterable, Iterator, NamedTuple
+
+from loguru import logger
+
+from tree_walk import FileRecord
+
+MANIFEST_PATH = "stat_manifest.sqlite"
+
+ADDED = "added"
+CHANGED = "changed"
+VANISHED = "vanished"
+# Manifest rows f not under a directory the last walk couldn't list
+UNSCANNED_FILTER = "NOT EXISTS (SELECT 1 FROM unscanned u WHERE substr(f.path, 1, length(u.prefix)) = u.prefix)"
+
+
+class ManifestChange(NamedTuple):
+    kind: str
+    path: str
+    size: int
+    mtime_ns: int
+
+
+class StatManifest:
+    """
+    Persisted (device, inode, size, mtime_ns) record of every file seen under each scanned top directory.
+
+    A rescan loads the freshly walked records into a temporary table and lets SQLite compute the
+    difference against the stored manifest, so neither side is held in Python memory.
+    """
+
+    def __init__(self, db_path=MANIFEST_PATH):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                top TEXT NOT NULL,
+                dev INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS files_top ON files(top);
+            CREATE TEMP TABLE IF NOT EXISTS seen (
+                path TEXT PRIMARY KEY,
+                dev INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER
+            );
+            CREATE TEMP TABLE IF NOT EXISTS unscanned (prefix TEXT PRIMARY KEY);
+            """
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def rescan(self, top, records: Iterable[FileRecord], unscanned: Iterable[str] = ()) -> Iterator[ManifestChange]:
+        """
+        Compare freshly walked records for top against the manifest and yield only the differences.
+        The manifest is not updated: call commit(top) once the changes have been applied, so a consumer
+        that fails or is interrupted before then sees the same changes again on the next run.
+        :param top: Root directory the records were walked from
+        :param records: FileRecords for every file currently under top
+        :param unscanned: Directories the walk couldn't list, read once records is exhausted (tree_walk.walk
+            fills its unscanned list as it goes). Files under them are not reported as vanished, and
+            commit keeps them in the manifest.
+        """
+        top = str(top)
+        self.db.execute("DELETE FROM seen")
+        self.db.execute("DELETE FROM unscanned")
+        self.db.executemany(
+            "INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?, ?)",
+            ((r.path, r.dev, r.inode, r.size, r.mtime_ns) for r in records),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO unscanned VALUES (?)",
+            ((d if d.endswith(os.sep) else d + os.sep,) for d in map(str, unscanned)),
+        )
+        seen_count = self.db.execute("SELECT count(*) FROM seen").fetchone()[0]
+        logger.debug(f"Manifest rescan of {top}: {seen_count} files on disk")
+
+        yield from self._changes(
+            ADDED,
+            "SELECT s.path, s.size, s.mtime_ns FROM seen s "
+            "LEFT JOIN files f ON f.path = s.path WHERE f.path IS NULL",
+        )
+        yield from self._changes(
+            CHANGED,
+            "SELECT s.path, s.size, s.mtime_ns FROM seen s JOIN files f ON f.path = s.path "
+            "WHERE f.dev != s.dev OR f.inode != s.inode OR f.size != s.size OR f.mtime_ns != s.mtime_ns",
+        )
+        yield from self._changes(
+            VANISHED,
+            "SELECT f.path, f.size, f.mtime_ns FROM files f "
+            "LEFT JOIN seen s ON s.path = f.path WHERE f.top = ? AND s.path IS NULL AND " + UNSCANNED_FILTER,
+            (top,),
+        )
+
+    def commit(self, top):
+        """Record the files seen by the last rescan of top as the manifest for top."""
+        top = str(top)
+        self.db.execute(
+            "DELETE FROM files AS f WHERE top = ? AND path NOT IN (SELECT path FROM seen) AND " + UNSCANNED_FILTER,
+            (top,),
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO files "
+            "SELECT s.path, ?, s.dev, s.inode, s.size, s.mtime_ns FROM seen s WHERE NOT EXISTS ("
+            "SELECT 1 FROM files f WHERE f.path = s.path AND f.top = ? AND f.dev = s.dev "
+            "AND f.inode = s.inode AND f.size = s.size AND f.mtime_ns = s.mtime_ns)",
+            (top, top),
+        )
+        self.db.execute("DELETE FROM seen")
+        self.db.execute("DELETE FROM unscanned")
+        self.db.commit()
+
+    def _changes(self, kind, query, params=()):
+        for path, size, mtime_ns in self.db.execute(query, params):
+            yield ManifestChange(kind, path, size, mtime_ns)
@@ -0,0 +1,89 @@
+import pytest
+
+from drive_walk import FOLDER, FolderIndex, GphotoSync
+from fake_drive import FakeDrive
+from me_models import Gphoto
+from rate_limit import RequestScheduler
+
+
+def photos_tree(drive, depth=3, breadth=3, files=4):
+    """A Google Photos folder with breadth subfolders per folder, depth levels deep; returns {file id: path}."""
+    photos = drive.add_folder("Google Photos", "root")
+    paths = {}
+    level = [(photos, ["Google Photos"])]
+    for d in range(depth + 1):
+        below = []
+        for folder, path in level:
+            for i in range(files):
+                paths[drive.add(f"img{d}_{i}.jpg", folder)] = path
+            drive.add("notes.txt", folder, mimeType="text/plain")
+            if d < depth:
+                for i in range(breadth):
+                    name = f"{path[-1]}.{i}"
+                    below.append((drive.add_folder(name, folder), path + [name]))
+        level = below
+    return paths
+
+
+@pytest.fixture
+def api():
+    return RequestScheduler("test", rate=1e6, burst=1e6, concurrency=16)
+
+
+def make_sync(drive, api, monkeypatch):
+    # get_root also upserts the root into the Gphoto collection; nothing else used here touches Mongo
+    photos = next(n for n in drive.children("root") if n["name"] == "Google Photos")
+    monkeypatch.setattr(GphotoSync, "get_root", lambda self: Gphoto(**self.steralize(photos)))
+    return GphotoSync(service_factory=drive, workers=4, api=api)
+
+
+def walked(sync):
+    return [node for nodes in sync.walk(sync.root) for node in nodes]
+
+
+def test_walk_yields_every_node_once_with_its_path(api, monkeypatch):
+    drive = FakeDrive()
+    paths = photos_tree(drive)
+    nodes = walked(make_sync(drive, api, monkeypatch))
+    folders = [node for node in nodes if node.mimeType == FOLDER]
+    assert len({node.gid for node in nodes}) == len(nodes)
+    assert {node.gid: node.path for node in nodes if node.mimeType != FOLDER} == paths
+    # One listing per folder, most of them sharing batch requests
+    assert drive.counts["files.list"] == len(folders) + 1
+    assert drive.counts["round_trips"] < drive.counts["files.list"] / 2
+
+
+def test_walk_pages_through_large_folders(api, monkeypatch):
+    drive = FakeDrive(page_size=3)
+    paths = photos_tree(drive, depth=2, files=7)
+    nodes = walked(make_sync(drive, api, monkeypatch))
+    folders = [node for node in nodes if node.mimeType == FOLDER]
+    assert {node.gid: node.path for node in nodes if node.mimeType != FOLDER} == paths
+    # 7 files and up to 3 folders a folder: 3 or 4 pages each
+    assert 3 * (len(folders) + 1) <= drive.counts["files.list"] <= 4 * (len(folders) + 1)
+
+
+def test_change_sync_fetches_only_folders_that_kept_photos_need(api, monkeypatch):
+    drive = FakeDrive()
+    paths = photos_tree(drive, depth=2)
+    reports = drive.add_folder("Reports", drive.add_folder("Work", "root"))
+    sync = make_sync(drive, api, monkeypatch)
+    start = len(drive.change_log)  # The folders above are already synced, but not indexed yet
+    nested = next(gid for gid, path in paths.items() if len(path) == 3)
+    photo = drive.add("new.jpg", drive.nodes[nested]["parents"][0])
+    drive.add("report.pdf", reports, mimeType="application/pdf")
+    sync.folder_index = FolderIndex(sync.root.gid, sync.root.name)
+    kept = sync.validate_drive_changes(drive.change_log[start:])
+    assert [change.fileId for change in kept] == [photo]
+    assert drive.counts["files.get"] == 2  # The photo's two ancestors below Google Photos, not Work or Reports
+
+
+def test_change_sync_paths_match_rebuild_paths(api, monkeypatch):
+    drive = FakeDrive()
+    photos_tree(drive, depth=3)
+    sync = make_sync(drive, api, monkeypatch)
+    rebuilt = {node.gid: node.path for node in walked(sync) if node.mimeType != FOLDER}
+    sync.folder_index = FolderIndex(sync.root.gid, sync.root.name)
+    changes = sync.validate_drive_changes(drive.change_log)
+    assert {change.fileId: change.gphoto.path for change in changes} == rebuilt
+    assert max(len(path) for path in rebuilt.values()) == 4  # Google Photos and three folders below it
@@ -0,0 +1,72 @@
+import pytest
+
+from stat_manifest import ADDED, CHANGED, VANISHED, StatManifest
+from tree_walk import FileRecord, walk
+
+TOP = "/photos"
+
+
+def record(name, size=100, mtime_ns=1_000_000_000, inode=None):
+    return FileRecord(f"{TOP}/{name}", size, mtime_ns / 1e9, inode or hash(name) & 0xFFFF, 1, mtime_ns)
+
+
+def rescan(manifest, records, flush, unscanned=()):
+    """The rescan_candidates pattern: apply every change, flush, and only then commit the manifest."""
+    changes = {(c.kind, c.path) for c in manifest.rescan(TOP, records, unscanned)}
+    flush(changes)
+    manifest.commit(TOP)
+    return changes
+
+
+def failing_flush(changes):
+    raise ConnectionError("Mongo went away")
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    with StatManifest(str(tmp_path / "manifest.sqlite")) as m:
+        yield m
+
+
+def test_reports_only_differences(manifest):
+    a, b = record("a.jpg"), record("b.jpg")
+    assert rescan(manifest, [a, b], lambda c: None) == {(ADDED, a.path), (ADDED, b.path)}
+    assert rescan(manifest, [a, b], lambda c: None) == set()
+    changed = record("b.jpg", size=200)
+    assert rescan(manifest, [changed], lambda c: None) == {(CHANGED, b.path), (VANISHED, a.path)}
+
+
+def test_failed_flush_is_reported_again(manifest):
+    a, b = record("a.jpg"), record("b.jpg")
+    rescan(manifest, [a, b], lambda c: None)
+    c, changed = record("c.jpg"), record("b.jpg", mtime_ns=2_000_000_000)
+    expected = {(ADDED, c.path), (CHANGED, b.path), (VANISHED, a.path)}
+    with pytest.raises(ConnectionError):
+        rescan(manifest, [changed, c], failing_flush)
+    assert rescan(manifest, [changed, c], lambda c: None) == expected
+    assert rescan(manifest, [changed, c], lambda c: None) == set()
+
+
+def test_failure_survives_reopening(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    a = record("a.jpg")
+    with StatManifest(path) as manifest:
+        with pytest.raises(ConnectionError):
+            rescan(manifest, [a], failing_flush)
+    with StatManifest(path) as manifest:
+        assert rescan(manifest, [a], lambda c: None) == {(ADDED, a.path)}
+
+
+def test_unscanned_directory_is_not_vanished(manifest):
+    a, b, c = record("album/a.jpg"), record("album/sub/b.jpg"), record("album2/c.jpg")
+    rescan(manifest, [a, b, c], lambda c: None)
+    assert rescan(manifest, [c], lambda c: None, unscanned=[f"{TOP}/album"]) == set()
+    assert rescan(manifest, [c], lambda c: None) == {(VANISHED, a.path), (VANISHED, b.path)}
+
+
+def test_walk_reports_unscanned_directories(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(b"x")
+    missing = str(tmp_path / "missing")
+    unscanned = []
+    assert [r.path for r in walk([tmp_path, missing], unscanned=unscanned)] == [str(tmp_path / "a.jpg")]
+    assert unscanned == [missing]
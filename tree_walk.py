@@ -0,0 +1,97 @@
+import os
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+from loguru import logger
+
+WALK_WORKERS = 8
+EXCLUDED_DIRS = {"$RECYCLE.BIN", "System Volume Information", ".git", "__pycache__"}
+
+
+class FileRecord(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+    inode: int
+    dev: int
+    mtime_ns: int
+
+
+def walk(
+    tops: Iterable,
+    extensions: Optional[Iterable[str]] = None,
+    exclude_dirs: Iterable[str] = EXCLUDED_DIRS,
+    excluded: Optional[Counter] = None,
+    workers: int = WALK_WORKERS,
+    unscanned: Optional[List[str]] = None,
+) -> Iterator[FileRecord]:
+    """
+    Walk directory trees with a bounded pool of os.scandir workers, yielding a FileRecord per file.
+
+    Directory listing on network shares and USB disks is latency bound, so several directories are
+    listed concurrently. Each file is stat'ed at most once, through the DirEntry cache, and only after
+    its extension has passed the filter. A directory that can't be listed is logged and skipped; pass
+    unscanned to find out which, since the files under it are unknown rather than gone.
+    :param tops: Root directories to walk
+    :param extensions: Lower case extensions (with dot) to keep; None keeps everything
+    :param exclude_dirs: Directory names that are pruned without being listed
+    :param excluded: Counter updated with the extension (without dot) of every file filtered out
+    :param workers: Number of concurrent directory listings
+    :param unscanned: List extended with every directory that couldn't be listed
+    """
+    extensions = set(extensions) if extensions is not None else None
+    exclude_dirs = set(exclude_dirs)
+    frontier = deque(str(top) for top in tops)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        while frontier or in_flight:
+            while frontier and len(in_flight) < workers * 2:
+                in_flight.add(executor.submit(_scan_dir, frontier.popleft(), extensions, exclude_dirs))
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs, skipped, failed = future.result()
+                frontier.extend(subdirs)
+                if failed and unscanned is not None:
+                    unscanned.append(failed)
+                if excluded is not None:
+                    excluded.update(skipped)
+                yield from files
+
+
+def _scan_dir(directory, extensions, exclude_dirs):
+    files: List[FileRecord] = []
+    subdirs = []
+    skipped = []
+    failed = None
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in exclude_dirs:
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    ext = os.path.splitext(entry.name)[1].lower()
+                    if extensions is not None and ext not in extensions:
+                        skipped.append(ext.replace(".", ""))  # Database can't handle keys starting with dot
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    files.append(
+                        FileRecord(
+                            entry.path,
+                            st.st_size,
+                            st.st_mtime,
+                            entry.inode(),
+                            st.st_dev,
+                            st.st_mtime_ns,
+                        )
+                    )
+                except OSError as e:
+                    logger.warning(f"Can't stat {entry.path}: {e}")
+    except OSError as e:
+        logger.warning(f"Can't scan {directory}: {e}")
+        failed = directory
+    return files, subdirs, skipped, failed
@@ -1,15 +1,19 @@
 import datetime
-from pathlib import Path
+import os.path
+import sys
+from collections import Counter
 from typing import List
 
 from loguru import logger
 import arrow
+from pymongo import DeleteMany
 
+from bulk_writer import WRITE_BATCH_SIZE, BulkWriter, queue_upsert
 from me_models import DbConnect, Queue
+from stat_manifest import ADDED, CHANGED, VANISHED, StatManifest
+from tree_walk import walk
 from utils import config
 
-WRITE_BATCH_SIZE = 1000
-
 cfg = config()
 logger.add("build_queue.log", rotation="1 MB")
 DbConnect()
@@ -19,7 +23,7 @@ def update_candidates(dirlist: List[str]):
     logger.info(f"Walking target list: {dirlist}")
     total_files = 0
     batch = []
-    excluded = set()
+    excluded = Counter()
     for top in dirlist:
         logger.info(f"Traversing tree at {top} and adding to queue.")
         pathset = set()
@@ -27,23 +31,17 @@ def update_candidates(dirlist: List[str]):
             pathset.add(f.src_path)
             if n % 10000 == 0:
                 logger.info(f"Processed {n}")
-        for n, path in enumerate(Path(top).rglob("**/*")):
+        for n, record in enumerate(walk([top], extensions=cfg.local.image_filetypes, excluded=excluded)):
             if n % 10000 == 0:
                 logger.info(f"Procesed: {n}")
-            if not path.is_file():
-                continue
-            ext = path.suffix.lower()
-            if ext not in cfg.settings.image_filetypes:
-                excluded.update([ext.replace(".", "")])
-                continue
-            if str(path) not in pathset:
-                logger.info(f"Adding: {path}")
+            if record.path not in pathset:
+                logger.info(f"Adding: {record.path}")
                 batch.append(
                     Queue(
-                        src_path=str(path),
-                        src_filename=str(path.name),
-                        size=path.stat().st_size,
-                        modifiedTime=arrow.get(path.stat().st_mtime).datetime
+                        src_path=record.path,
+                        src_filename=os.path.basename(record.path),
+                        size=record.size,
+                        modifiedTime=arrow.get(record.mtime).datetime
                     )
                 )
                 if len(batch) >= WRITE_BATCH_SIZE:
@@ -53,6 +51,48 @@ def update_candidates(dirlist: List[str]):
     return excluded
 
 
+def rescan_candidates(dirlist: List[str]):
+    """
+    Incremental version of update_candidates: only files added, changed or vanished since the last
+    rescan (according to the stat manifest) touch the database. Files under a directory that can't be
+    listed are left alone rather than deleted, and a missing top directory (an unplugged drive, an
+    offline share) aborts the rescan before anything is written.
+    """
+    missing = [top for top in dirlist if not os.path.isdir(top)]
+    if missing:
+        raise FileNotFoundError(f"Not rescanning: {missing} missing")
+    logger.info(f"Rescanning target list: {dirlist}")
+    excluded = Counter()
+    counts = {ADDED: 0, CHANGED: 0, VANISHED: 0}
+    vanished = []
+    with StatManifest() as manifest, BulkWriter(Queue._get_collection()) as writer:
+        for top in dirlist:
+            logger.info(f"Rescanning tree at {top}")
+            unscanned = []
+            for change in manifest.rescan(
+                top, walk([top], extensions=cfg.local.image_filetypes, excluded=excluded, unscanned=unscanned), unscanned
+            ):
+                counts[change.kind] += 1
+                if change.kind == VANISHED:
+                    vanished.append(change.path)
+                    if len(vanished) >= WRITE_BATCH_SIZE:
+                        writer.add(DeleteMany({"src_path": {"$in": vanished}, "purged": False}))
+                        vanished = []
+                else:
+                    writer.add(
+                        queue_upsert(change.path, change.size, change.mtime_ns / 1e9, reset=change.kind == CHANGED)
+                    )
+            if vanished:
+                writer.add(DeleteMany({"src_path": {"$in": vanished}, "purged": False}))
+                vanished = []
+            if unscanned:
+                logger.warning(f"Kept the Queue entries under {len(unscanned)} directories that couldn't be scanned")
+            writer.flush()
+            manifest.commit(top)  # Only once the Queue has the changes, so a failed write is retried
+    logger.info(f"Rescan found {counts[ADDED]} added, {counts[CHANGED]} changed, {counts[VANISHED]} vanished")
+    return excluded
+
+
 def write_batch(batch, total_files):
     if len(batch):
         Queue.objects.insert(batch)
@@ -63,9 +103,10 @@ def write_batch(batch, total_files):
 
 if __name__ == "__main__":
     dirlist = [r"D:\Gphotos Mirror\Google Photos"]
+    incremental = "--full" not in sys.argv
     logger.info("Starting queue update")
     start = datetime.datetime.now()
-    excluded = update_candidates(dirlist)
+    excluded = rescan_candidates(dirlist) if incremental else update_candidates(dirlist)
     elapsed = datetime.datetime.now() - start
     logger.info(
         f"Done queue update. Elapsed time: {elapsed}. Excluded file types: {excluded}"
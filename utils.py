@@ -54,12 +54,19 @@ class PathHistory:
     collection: str
 
 
+@dataclass
+class SourceArchive:
+    host: str
+    database: str
+
+
 @dataclass
 class Cfg:
     settings: Settings
     local: Local
     gphotos: Gphotos
     path_history: PathHistory
+    source_archive: SourceArchive
 
 
 def config():
@@ -70,5 +77,6 @@ def config():
         local=Local(**config_dict["local"]),
         gphotos=Gphotos(**config_dict["gphotos"]),
         path_history=PathHistory(**config_dict["path_history"]),
+        source_archive=SourceArchive(**config_dict["source_archive"]),
     )
     return cfg